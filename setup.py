@@ -28,19 +28,21 @@ setup(
         "Operating System :: MacOS :: MacOS X",
         "Operating System :: Microsoft :: Windows",
         "Operating System :: POSIX :: Linux",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Topic :: Software Development :: Testing",
     ],
     keywords="alexa automated testing",
+    python_requires=">=3.7",
     py_modules=["skilltest"],
     install_requires=["boto3",
                       "bs4",
-                      "numpy",
+                      "numpy>=1.20",
                       "requests",
-                      "requests_toolbelt",
                       "samplerate",
                       "soundfile"],
     entry_points={
@@ -9,38 +9,87 @@
 #
 # =============================================================================
 
-from __future__ import print_function
-
 import argparse
+import atexit
 import base64
+import bisect
+import cProfile
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import importlib.machinery
+import importlib.util
 import io
 import itertools
 import json
+import math
 import multiprocessing
-import numpy as np
+import multiprocessing.util
 import os
+import queue
 import random
 import re
-import requests
-import samplerate
 import shlex
-import soundfile
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import traceback
 import types
-from boto3 import client as awsclient
-from bs4 import BeautifulSoup
-from concurrent.futures import ProcessPoolExecutor
+import unittest
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from copy import deepcopy
-from datetime import datetime
-from requests_toolbelt import MultipartDecoder
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from subprocess import Popen, PIPE, check_output
+from urllib.parse import unquote_plus, quote_plus, urlparse, parse_qs, urljoin
+
+class LazyModule(object):
+    # Stands in for a module until something in it is first used, so runs and
+    # pool workers that never need it don't pay for it.  The real import goes
+    # through import_module, which holds the module's import lock until it has
+    # finished, so threads that race on first use all see the whole module.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module %r>" % self._name
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError("No module named %r" % name, name=name)
+    return LazyModule(name)
+
+# Heavy dependencies
+asyncio = lazy_import("asyncio")
+boto3 = lazy_import("boto3")
+bs4 = lazy_import("bs4")
+np = lazy_import("numpy")
+pstats = lazy_import("pstats")
+requests = lazy_import("requests")
+samplerate = lazy_import("samplerate")
+soundfile = lazy_import("soundfile")
 
 try:
-    from urllib.parse import unquote_plus, quote_plus, urlparse, parse_qs, urljoin
+    import fcntl
 except ImportError:
-    from urllib import unquote_plus, quote_plus
-    from urlparse import urlparse, parse_qs, urljoin
+    import msvcrt
+    fcntl = None
 
 OPTS = None
 
@@ -49,7 +98,32 @@ SUB_RE = re.compile(r"{(?P<var>.*?)\}[/\\]*")
 
 PLAT = sys.platform
 
-SQS = awsclient("sqs")
+# Per process synthesizer when running persistent synthesizer sessions
+SYNTH = None
+
+# Per process view of the shared AVS token cache
+TOKENS = None
+
+# Per process AVS client so its connections get reused
+CLIENT = None
+
+# Created on first use so the endpoint can come from the configuration
+SQS = None
+
+# Per process background writer for voice input files when handing audio
+# straight to AVS
+WRITER = None
+
+# Per process profiler for the stage being profiled
+PROFILER = None
+
+# Per process cache of trimmed phrase audio when splicing utterances
+PHRASES = OrderedDict()
+PHRASES_MAX = 512
+
+# Covering arrays already built, keyed by strength and slot sizes, since many
+# templates share the same shape
+COVERING = {}
 
 CFG = \
 {
@@ -57,20 +131,77 @@ CFG = \
     "outputdir": "./results/output",
     "skilldir": "./skill",
     "testsdir": "./tests",
+    "plandir": "./results/plans",
     "bypass": False,
-    "regen": False,
+    "cover": 0,
     "keep": False,
+    "fingerprint": False,
+    "similarity": 0.9,
     "avstasks": 1,
     "ttstasks": 1,
+    "avspool": 4,
+    "adaptive": False,
+    "avsmax": 32,
+    "retries": 4,
+    "backoff": 0.5,
+    "backoffmax": 30.0,
+    "keepalive": True,
+    "engine": "process",
+    "pipeline": False,
+    "handoff": "file",
+    "persist": True,
     "synth": "sapi" if PLAT == "win32" else "osx" if PLAT == "darwin" else "espeak",
+    "voice": "",
+    "cachesize": 0,
+    "synthserver": False,
+    "resample": "sinc_fastest",
+    "splice": False,
+    "splicegap": 40,
+    "splicefade": 10,
+    "trim": False,
+    "trimdb": -40.0,
+    "trimpad": 30,
+    "normalize": "",
+    "level": -3.0,
     "invocation":  "your skill's invocation name",
+    "locale": "en-us",
+    "skillversion": "",
+    "incremental": False,
     "queueurl": "results SQS queue URL",
+    "sqswait": 10,
+    "unitmode": "shell",
+    "unittasks": 1,
     "email": "your AVS email address",
     "password": "your AVS password",
     "clientid": "your AVS device clientid",
     "secret": "your AVS device secret",
     "deviceid": "your AVS device type ID",
-    "redirect": "your AVS device redirect URL"
+    "redirect": "your AVS device redirect URL",
+    "tokencache": "~/.skilltest_tokens",
+    "valuecache": "",
+    "valuettl": 0,
+    "resultsdb": "",
+    "resultsaudio": False,
+    "metrics": "",
+    "metricsformat": "jsonl",
+    "profile": "",
+    "avsurl": "https://access-alexa-na.amazon.com",
+    "loginurl": "https://www.amazon.com",
+    "apiurl": "https://api.amazon.com",
+    "sqsendpoint": "",
+    "fake":
+    {
+        "latency": 0.5,
+        "jitter": 0.2,
+        "errors": 0.0,
+        "forbidden": 0.0,
+        "audiosize": 16384,
+        "capacity": 0,
+        "retryafter": 0,
+        "distinct": 0,
+        "expires": 3600,
+        "requests": 200
+    }
 }
 
 # Minimum required extra headers
@@ -82,12 +213,265 @@ HEADERS = \
     "User-Agent": "Links (2.14; CYGWIN_NT-10.0 2.6.1(0.305/5/3) x86_64; GNU C 5.4; text)"
 }
 
-def run_tts(filepfx, text):
+class Metrics(object):
+    # Timings of each stage of the work, as histograms, and counts of what it
+    # moved.  Every process keeps its own.  Workers hand theirs back with the
+    # results of each job and the main process adds them up.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+    def observe(self, stage, secs):
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = {"count": 0, "sum": 0.0, "min": secs, "max": secs,
+                                             "buckets": [0] * (len(Metrics.BUCKETS) + 1)}
+            hist["count"] += 1
+            hist["sum"] += secs
+            hist["min"] = min(hist["min"], secs)
+            hist["max"] = max(hist["max"], secs)
+            hist["buckets"][bisect.bisect_left(Metrics.BUCKETS, secs)] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def take(self):
+        # Everything since the last call
+        with self.lock:
+            snapshot = {"stages": self.stages, "counters": self.counters}
+            self.stages = {}
+            self.counters = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for stage, other in snapshot["stages"].items():
+                hist = self.stages.get(stage)
+                if hist is None:
+                    self.stages[stage] = deepcopy(other)
+                    continue
+                hist["count"] += other["count"]
+                hist["sum"] += other["sum"]
+                hist["min"] = min(hist["min"], other["min"])
+                hist["max"] = max(hist["max"], other["max"])
+                hist["buckets"] = [a + b for a, b in zip(hist["buckets"], other["buckets"])]
+            for name, n in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, stats):
+        if stats is not None and "metrics" in stats:
+            self.merge(stats["metrics"])
+
+    @staticmethod
+    def percentile(hist, q):
+        # Interpolated within the bucket it falls in
+        rank = q * hist["count"]
+        seen = 0
+        for ndx, n in enumerate(hist["buckets"]):
+            if n and seen + n >= rank:
+                lo = Metrics.BUCKETS[ndx - 1] if ndx > 0 else 0.0
+                hi = Metrics.BUCKETS[ndx] if ndx < len(Metrics.BUCKETS) else hist["max"]
+                value = lo + (hi - lo) * (rank - seen) / n
+                return min(max(value, hist["min"]), hist["max"])
+            seen += n
+        return hist["max"]
+
+    def records(self, **fields):
+        # One JSON-able record per stage and per counter
+        records = []
+        for stage in sorted(self.stages):
+            hist = self.stages[stage]
+            record = dict(fields, type="stage", stage=stage, count=hist["count"], sum=hist["sum"],
+                          min=hist["min"], max=hist["max"],
+                          buckets=[[le, n] for le, n in zip(list(Metrics.BUCKETS) + ["+Inf"],
+                                                            itertools.accumulate(hist["buckets"]))])
+            for q in (50, 90, 99):
+                record["p%d" % q] = Metrics.percentile(hist, q / 100.0)
+            records.append(record)
+        for name in sorted(self.counters):
+            records.append(dict(fields, type="counter", name=name, value=self.counters[name]))
+        return records
+
+    def prometheus(self):
+        lines = []
+        if self.stages:
+            lines.append("# HELP skilltest_stage_seconds Time spent in each stage of a run")
+            lines.append("# TYPE skilltest_stage_seconds histogram")
+        for stage in sorted(self.stages):
+            hist = self.stages[stage]
+            for le, n in zip(list(Metrics.BUCKETS) + ["+Inf"], itertools.accumulate(hist["buckets"])):
+                lines.append('skilltest_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, le, n))
+            lines.append('skilltest_stage_seconds_sum{stage="%s"} %f' % (stage, hist["sum"]))
+            lines.append('skilltest_stage_seconds_count{stage="%s"} %d' % (stage, hist["count"]))
+        for name in sorted(self.counters):
+            lines.append("# TYPE skilltest_%s_total counter" % name)
+            lines.append("skilltest_%s_total %d" % (name, self.counters[name]))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        print("%-10s %8s %10s %9s %9s %9s %9s %9s" %
+              ("stage", "count", "total s", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        print("-" * 80)
+        for stage in sorted(self.stages, key=lambda s: -self.stages[s]["sum"]):
+            hist = self.stages[stage]
+            print("%-10s %8d %10.2f %9.1f %9.1f %9.1f %9.1f %9.1f" %
+                  (stage, hist["count"], hist["sum"], hist["sum"] / hist["count"] * 1000,
+                   Metrics.percentile(hist, 0.5) * 1000, Metrics.percentile(hist, 0.9) * 1000,
+                   Metrics.percentile(hist, 0.99) * 1000, hist["max"] * 1000))
+        if self.counters:
+            print()
+            print(", ".join("%s %d" % (name.replace("_", " "), self.counters[name])
+                            for name in sorted(self.counters)))
+
+class Timer(object):
+    # Times a stage into this process's metrics, profiling it as well when
+    # it's the stage being profiled
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        global PROFILER
+
+        self.profiling = OPTS is not None and OPTS.profile == self.stage
+        if self.profiling:
+            if PROFILER is None:
+                PROFILER = cProfile.Profile()
+            try:
+                PROFILER.enable()
+            except ValueError:
+                # Already profiling this stage on another thread
+                self.profiling = False
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        METRICS.observe(self.stage, time.perf_counter() - self.start)
+        if self.profiling:
+            PROFILER.disable()
+        return False
+
+def timed(stage):
+    # Times every call of a function as the given stage
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def dump_profile():
+    # Each process writes its own profile of the stage
+    if PROFILER is not None:
+        path = os.path.join(OPTS.outputdir, "profile", "%s.%d.prof" % (OPTS.profile, os.getpid()))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        PROFILER.dump_stats(path)
+
+def report_profile():
+    # Combine every process's profile of the stage into one
+    root = os.path.join(OPTS.outputdir, "profile")
+    paths = [os.path.join(root, name) for name in sorted(os.listdir(root))
+             if name.startswith(OPTS.profile + ".") and name.count(".") == 2] if os.path.isdir(root) else []
+    if not paths:
+        print("Profile: the %s stage never ran" % OPTS.profile)
+        return
+
+    stats = pstats.Stats(*paths, stream=sys.stdout)
+    path = os.path.join(root, OPTS.profile + ".prof")
+    stats.dump_stats(path)
+    print("Profile of the %s stage from %d process(es) written to %s" % (OPTS.profile, len(paths), path))
+    stats.sort_stats("cumulative").print_stats(20)
+
+# Per process stage timings and counts
+METRICS = Metrics()
+
+def speak(text, phrases=None):
+    # The whole utterance, or the utterance spliced together from the audio
+    # of its phrases
+    if phrases is None:
+        return get_tts().pcm("alexa ask %s %s" % (OPTS.invocation, text))
+
+    clips, trimmed = load_phrases(phrases)
+    raw = splice(clips)
+    if Conditioner.enabled():
+        return Conditioner().process(raw, trimmed)
+    return quantize(raw)
+
+def quantize(raw):
+    # Scale and round the same way libsndfile does so the samples match what
+    # writing the float audio to a WAV file would give
+    scaled = np.multiply(raw, 32768.0, dtype=np.float64 if raw.dtype == np.float64 else np.float32)
+    np.floor(scaled, out=scaled)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    return scaled.astype(np.int16)
+
+def load_phrases(paths):
+    # Phrases not used recently are read and trimmed together.  Along with
+    # the clips comes how much silence was trimmed from them, so it can be
+    # counted for each utterance they're spliced into.
+    missing = [path for path in OrderedDict.fromkeys(paths) if path not in PHRASES]
+    if missing:
+        raws = [soundfile.read(path, dtype="float32")[0] for path in missing]
+        clips = Conditioner().trim_many(raws)
+        for path, raw, clip in zip(missing, raws, clips):
+            PHRASES[path] = (clip, len(raw) - len(clip))
+
+    for path in paths:
+        PHRASES.move_to_end(path)
+    clips = [PHRASES[path][0] for path in paths]
+    trimmed = sum(PHRASES[path][1] for path in paths)
+    while len(PHRASES) > PHRASES_MAX:
+        PHRASES.popitem(last=False)
+    return clips, trimmed
+
+@timed("splice")
+def splice(clips):
+    # Each clip is followed by the gap and then crossfaded into the next
+    gap = int(OPTS.splicegap * 16)
+    fade = int(OPTS.splicefade * 16)
+
+    joins = []
+    end = 0
+    for clip in clips:
+        overlap = min(fade, end, len(clip))
+        joins.append((end - overlap, overlap))
+        end = end - overlap + len(clip) + gap
+    out = np.zeros(max(end - gap, 0), dtype=np.float32)
+
+    for clip, (start, overlap) in zip(clips, joins):
+        clip = clip.astype(np.float32)
+        # Ramp in over the end of what came before and ramp that out
+        if overlap > 0:
+            ramp = np.linspace(0.0, 1.0, overlap, endpoint=False, dtype=np.float32)
+            out[start:start + overlap] *= ramp[::-1]
+            clip[:overlap] *= ramp
+        out[start:start + len(clip)] += clip
+
+    return out
+
+def run_phrase(path, text):
+    try:
+        # Phrases are kept as synthesized and conditioned once spliced
+        write_wav(path, get_tts().pcm(text, condition=False))
+        return worker_stats()
+    except Exception as e:
+        print("Caught exception generating phrase:")
+        print(text)
+        print()
+        traceback.print_exc()
+        print()
+        raise e
+
+def run_tts(path, text, phrases=None):
     try:
-        soundfile.write(os.path.join(OPTS.inputdir, filepfx + ".wav"),
-                        TTS().convert("alexa ask %s %s" % (OPTS.invocation, text)),
-                        16000,
-                        format="WAV")
+        write_wav(path, speak(text, phrases))
+        return worker_stats()
     except Exception as e:
         print("Caught exception generating:")
         print(text)
@@ -96,22 +480,1814 @@ def run_tts(filepfx, text):
         print()
         raise e
 
-def run_avs(filepfx):
+@timed("write")
+def write_wav(path, pcm):
+    # Write to a temporary name first so a partial file never looks cached
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    soundfile.write(tmp, pcm, 16000, format="WAV", subtype="PCM_16")
+    os.replace(tmp, path)
+
+def get_writer():
+    global WRITER
+
+    if WRITER is None:
+        WRITER = ThreadPoolExecutor(max_workers=1)
+
+    return WRITER
+
+def run_handoff(path, text, filepfx, phrases=None):
+    # Synthesize and recognize in one step.  The PCM goes straight from the
+    # synthesizer into the request body and is only written to the voice
+    # input cache, if at all, while the request is under way.
+    try:
+        pcm = speak(text, phrases)
+        written = get_writer().submit(write_wav, path, pcm) if path is not None else None
+
+        avs = get_avs()
+        save_avs(avs, memoryview(pcm), filepfx)
+        if written is not None:
+            written.result()
+        return worker_stats(avs)
+    except Exception as e:
+        print("Caught exception generating and recognizing:")
+        print(text)
+        print()
+        traceback.print_exc()
+        print()
+        raise e
+
+def get_tts():
+    global SYNTH
+
+    if not OPTS.synthserver:
+        return TTS()
+
+    # A session inherited from the process that forked this one belongs to
+    # that process, so it is left alone rather than closed
+    if SYNTH is not None and SYNTH.pid != os.getpid():
+        SYNTH = None
+
+    # Start over if a test switched synthesizers or voices
+    if SYNTH is not None and SYNTH.settings != (OPTS.synth, TTS.voice()):
+        SYNTH.close()
+        SYNTH = None
+
+    # Pool workers don't need to close it as the session goes away with them
+    if SYNTH is None:
+        SYNTH = TTS(persistent=True)
+        atexit.register(SYNTH.close)
+
+    return SYNTH
+
+def get_sqs():
+    global SQS
+
+    if SQS is None:
+        SQS = boto3.client("sqs", endpoint_url=OPTS.sqsendpoint or None)
+
+    return SQS
+
+def get_avs():
+    global CLIENT
+
+    # Pool workers forked after the main process has used its client must not
+    # share its connections, so each process builds its own
+    if CLIENT is None or CLIENT.pid != os.getpid() or CLIENT.settings != (OPTS.avspool, OPTS.keepalive):
+        CLIENT = AVS()
+
+    return CLIENT
+
+def run_avs(path, filepfx):
     try:
-        with open(os.path.join(OPTS.inputdir, filepfx + ".wav"), "rb") as infile:
-            with open(os.path.join(OPTS.outputdir, filepfx + ".mp3"), "wb") as outfile:
-                outfile.write(AVS().recognize(infile))
+        avs = get_avs()
+        with open(path, "rb") as infile:
+            save_avs(avs, infile, filepfx)
+        return worker_stats(avs)
     except Exception as e:
         print("Caught exception recognizing:")
-        print(filepfx + ".wav")
+        print(path)
         print()
         traceback.print_exc()
         print()
         raise e
 
+def save_avs(avs, wav, filepfx):
+    # The response audio streams into a new file, which then replaces any
+    # earlier response.  An earlier one may be linked to others that are the
+    # same, so it must never be written over.
+    path = os.path.join(OPTS.outputdir, filepfx + ".mp3")
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, "wb") as outfile:
+            directives = avs.recognize(wav, outfile)
+        if directives is None:
+            raise RuntimeError("AVS request failed")
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    # Keep what AVS said along with what the skill said
+    if OPTS.keep:
+        with open(os.path.join(OPTS.outputdir, filepfx + ".json"), "wt") as f:
+            json.dump(directives, f, indent=4)
+
+    return directives
+
+def run_fingerprint(paths, known):
+    # Hash each response and fingerprint the ones not seen before
+    entries = []
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            entries.append(None)
+            continue
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 in known:
+            entries.append((sha1, len(data), None))
+        else:
+            entries.append((sha1, len(data), Fingerprint.compute(data)))
+            known.add(sha1)
+    return entries, worker_stats()
+
+def worker_init():
+    # Pool workers start out as copies of the main process, so they forget
+    # what it already timed, counted and profiled rather than report it again
+    global METRICS, PROFILER
+
+    METRICS = Metrics()
+    PROFILER = None
+    Conditioner.totals = [0, 0, 0]
+
+    # Its profile is written out once, when the pool shuts the worker down
+    multiprocessing.util.Finalize(None, dump_profile, exitpriority=10)
+
+def worker_stats(avs=None):
+    # What a job tells the main process about the work it did
+    stats = {"audio": Conditioner.stats()}
+    if avs is not None:
+        stats["hosts"] = avs.stats()
+    stats["metrics"] = METRICS.take()
+    return stats
+
+def submit_bounded(executor, pending, limit, fn, *args, callback=None):
+    # Keep at most limit jobs queued so huge matrices stream through the pool
+    # instead of piling up as futures
+    while len(pending) >= limit:
+        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+    future = executor.submit(fn, *args)
+    if callback is not None:
+        future.add_done_callback(callback)
+    pending.add(future)
+    return pending
+
+def run_item(opts, fn, *args):
+    # Pool workers outlive any one test, so each job brings along the
+    # options of the test it belongs to
+    global OPTS
+
+    OPTS = opts
+    return fn(*args)
+
+class Batch(object):
+    # The jobs one phase of a test has submitted to a pool.  At most limit
+    # are outstanding at a time, or as many as the throttle allows, and
+    # join() waits for their callbacks as well, which shutting down a private
+    # pool used to take care of.
+    def __init__(self, executor, limit, throttle=None):
+        self.executor = executor
+        self.limit = limit
+        self.throttle = throttle
+        self.cond = threading.Condition()
+        self.outstanding = 0
+
+    def capacity(self):
+        return self.throttle.window() if self.throttle is not None else self.limit
+
+    def submit(self, fn, *args, callback=None):
+        with self.cond:
+            while self.outstanding >= self.capacity():
+                self.cond.wait()
+            self.outstanding += 1
+
+        def finished(future):
+            try:
+                if callback is not None:
+                    callback(future)
+            finally:
+                with self.cond:
+                    self.outstanding -= 1
+                    self.cond.notify_all()
+
+        future = self.executor.submit(run_item, OPTS, fn, *args)
+        future.add_done_callback(finished)
+        return future
+
+    def join(self):
+        with self.cond:
+            while self.outstanding > 0:
+                self.cond.wait()
+
+class Scheduler(object):
+    # One TTS pool and one AVS pool serve every test in the run, so workers,
+    # along with their synthesizer sessions and AVS connections, carry over
+    # from test to test.  The pools are sized for the busiest test and only
+    # started when first needed.  Each test still gets the concurrency it
+    # asked for.
+    def __init__(self, ttstasks, avstasks):
+        self.sizes = {"tts": ttstasks, "avs": avstasks}
+        self.pools = {}
+
+    def pool(self, kind):
+        if kind not in self.pools:
+            self.pools[kind] = ProcessPoolExecutor(max_workers=self.sizes[kind], initializer=worker_init)
+        return self.pools[kind]
+
+    def batch(self, kind, tasks, throttle=None):
+        # Only queue ahead when the test can use the whole pool.  A throttled
+        # batch never queues ahead, since its limit is the number of requests
+        # actually under way.
+        size = self.sizes[kind]
+        return Batch(self.pool(kind), tasks * 2 if tasks >= size else tasks, throttle)
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+        self.pools = {}
+
+class Throttle(object):
+    # Adapts the number of concurrent AVS requests to what the service will
+    # take: additive increase, multiplicative decrease.  Each request answered
+    # without being throttled grows the limit by 1/limit, so by about one for
+    # each full window of answers.  A throttled or lost request halves it,
+    # but only once per window, since the requests already under way were
+    # sent at the old limit and will be throttled too.
+    DECREASE = 0.5
+
+    def __init__(self, start, ceiling):
+        self.start = start
+        self.ceiling = max(ceiling, start)
+        self.limit = float(start)
+        self.lock = threading.Lock()
+        self.since = 0
+        self.throttled = 0
+        self.lost = 0
+        self.decreases = 0
+        self.history = []
+
+    def window(self):
+        return max(1, int(self.limit))
+
+    def add(self, stats):
+        # Only AVS jobs report hosts
+        if stats is None or "hosts" not in stats:
+            return
+        throttled = stats.get("metrics", {}).get("counters", {}).get("throttled", 0)
+        self.update(throttled, False)
+
+    def fail(self):
+        self.update(0, True)
+
+    def update(self, throttled, lost):
+        with self.lock:
+            self.since += 1
+            self.throttled += throttled
+            self.lost += lost
+            if throttled or lost:
+                if self.since >= self.window():
+                    self.limit = max(1.0, self.limit * Throttle.DECREASE)
+                    self.decreases += 1
+                    self.since = 0
+            else:
+                self.limit = min(float(self.ceiling), self.limit + 1.0 / self.limit)
+            self.history.append((time.time(), self.limit))
+
+    def steady(self):
+        # The limit and rate over the second half of the answers, by which
+        # time the limit has found its level.  It takes a few windows' worth
+        # of answers for the rate to mean anything.
+        with self.lock:
+            history = self.history[len(self.history) // 2:]
+        if not history:
+            return None, None
+        limit = sum(limit for _, limit in history) / len(history)
+        if len(history) < 2 * limit or history[-1][0] <= history[0][0]:
+            return limit, None
+        rate = (len(history) - 1) / (history[-1][0] - history[0][0])
+        return limit, rate
+
+    def report(self):
+        limit, rate = self.steady()
+        print("Adaptive concurrency: started at %d, limit %d, %d throttled response(s), "
+              "%d lost request(s), %d decrease(s)" %
+              (self.start, self.ceiling, self.throttled, self.lost, self.decreases))
+        if rate is not None:
+            print("Steady state: %.1f concurrent request(s), %.1f utt/sec" % (limit, rate))
+        elif limit is not None:
+            print("Steady state: %.1f concurrent request(s), too few answers for a rate" % limit)
+
+class ConnectionStats(object):
+    # Totals of the per request and new connection counts reported by the
+    # AVS clients in each process.  Jobs finishing on different threads
+    # add theirs at the same time.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def add(self, stats):
+        if stats is None:
+            return
+        with self.lock:
+            for host, (sent, opened) in stats.get("hosts", {}).items():
+                totals = self.hosts.setdefault(host, [0, 0])
+                totals[0] += sent
+                totals[1] += opened
+
+    def report(self):
+        for host in sorted(self.hosts):
+            sent, opened = self.hosts[host]
+            reused = 100.0 * (sent - opened) / sent if sent else 0.0
+            print("Connections: %s: %d request(s), %d connection(s) opened, %.1f%% reused" %
+                  (host, sent, opened, reused))
+
+def covering_array(sizes, strength):
+    # IPOG: start with every combination of the largest "strength" slots, then
+    # add the remaining slots one at a time.  Each existing row first gets
+    # whichever value of the new slot covers the most missing tuples, and any
+    # tuples still missing get rows of their own, with the slots they don't
+    # need left open so later tuples can fill them in.  Rows are returned as
+    # tuples of value indexes in the caller's slot order.
+    key = (strength, tuple(sizes))
+    if key in COVERING:
+        return COVERING[key]
+
+    order = sorted(range(len(sizes)), key=lambda p: -sizes[p])
+    s = [sizes[p] for p in order]
+    if 0 in s:
+        return []
+
+    rows = [list(r) for r in itertools.product(*[range(n) for n in s[:strength]])]
+    loose = []
+    for i in range(strength, len(s)):
+        # The tuples not yet covered for each combination of earlier slots,
+        # as a matrix of their values' flat index by the new slot's values
+        combos = list(itertools.combinations(range(i), strength - 1))
+        missing = [np.ones((int(np.prod([s[p] for p in c])), s[i]), dtype=bool) for c in combos]
+        strides = []
+        for c in combos:
+            stride = [int(np.prod([s[q] for q in c[n + 1:]])) for n in range(len(c))]
+            strides.append(list(zip(c, stride)))
+
+        def flat(row, n):
+            k = 0
+            for p, stride in strides[n]:
+                if row[p] is None:
+                    return None
+                k += row[p] * stride
+            return k
+
+        # Horizontal growth
+        for row in rows:
+            keys = [(n, flat(row, n)) for n in range(len(combos))]
+            keys = [(n, k) for n, k in keys if k is not None]
+            gains = np.zeros(s[i], dtype=np.int32)
+            for n, k in keys:
+                gains += missing[n][k]
+            best = int(gains.argmax())
+            row.append(best)
+            for n, k in keys:
+                missing[n][k, best] = False
+
+        # Vertical growth, only looking at open rows with the right value for
+        # the new slot
+        byvalue = {}
+        for row in loose:
+            byvalue.setdefault(row[i], []).append(row)
+        for n, c in enumerate(combos):
+            dims = [s[p] for p in c]
+            for k, v in zip(*np.nonzero(missing[n])):
+                vals = [int(x) for x in np.unravel_index(k, dims)] if dims else []
+                bucket = byvalue.setdefault(int(v), [])
+                for row in bucket:
+                    if all(row[p] in (None, x) for p, x in zip(c, vals)):
+                        break
+                else:
+                    row = [None] * (i + 1)
+                    row[i] = int(v)
+                    rows.append(row)
+                    loose.append(row)
+                    bucket.append(row)
+                for p, x in zip(c, vals):
+                    row[p] = x
+                if None not in row:
+                    bucket.remove(row)
+        loose = [row for row in loose if None in row]
+
+    # Whatever is still open can take any value, so spread them around
+    covering = []
+    for n, row in enumerate(rows):
+        values = [0] * len(sizes)
+        for pos, p in enumerate(order):
+            values[p] = row[pos] if row[pos] is not None else n % s[pos]
+        covering.append(tuple(values))
+
+    COVERING[key] = covering
+    return covering
+
+class AudioStats(object):
+    # Totals of the voice input conditioned in each process, and how much
+    # silence was trimmed from it.  Jobs finishing on different threads add
+    # theirs at the same time.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clips = 0
+        self.before = 0
+        self.after = 0
+
+    def add(self, stats):
+        if stats is None:
+            return
+        clips, before, after = stats.get("audio", (0, 0, 0))
+        with self.lock:
+            self.clips += clips
+            self.before += before
+            self.after += after
+
+    def report(self):
+        saved = (self.before - self.after) / 16000.0
+        print("Voice input: %d clip(s) conditioned, %.1fs synthesized, %.1fs sent, %.1fs (%.1f%%) trimmed" %
+              (self.clips, self.before / 16000.0, self.after / 16000.0, saved,
+               100.0 * (self.before - self.after) / self.before if self.before else 0.0))
+
+class Template(object):
+    # An utterance compiled once into its literal fragments and the slot names
+    # between them, so resolving a permutation is just a join
+    __slots__ = ("utterance", "literals", "typenames", "positions")
+
+    def __init__(self, utterance):
+        parts = VAR_RE.split(utterance)
+        self.utterance = utterance
+        self.literals = parts[0::2]
+
+        # A slot used more than once gets the same value everywhere
+        self.typenames = list(OrderedDict.fromkeys(parts[1::2]))
+        self.positions = [self.typenames.index(t) for t in parts[1::2]]
+
+    def sizes(self, types):
+        return [len(types[typename]) for typename in self.typenames]
+
+    def covered(self):
+        # Only worth covering when there are more slots than the strength
+        return 0 < OPTS.cover < len(self.typenames)
+
+    def full(self, types):
+        count = 1
+        for size in self.sizes(types):
+            count *= size
+        return count
+
+    def count(self, types):
+        if self.covered():
+            return len(covering_array(self.sizes(types), OPTS.cover))
+        return self.full(types)
+
+    def indexes(self, types):
+        if self.covered():
+            return covering_array(self.sizes(types), OPTS.cover)
+        return itertools.product(*[range(size) for size in self.sizes(types)])
+
+    def combinations(self, types):
+        if self.covered():
+            values = [types[typename] for typename in self.typenames]
+            return (tuple(vals[i] for vals, i in zip(values, indexes))
+                    for indexes in self.indexes(types))
+        return itertools.product(*[types[typename] for typename in self.typenames])
+
+    def resolve(self, values):
+        resolved = [self.literals[0]]
+        for pos, literal in zip(self.positions, self.literals[1:]):
+            resolved.append(values[pos])
+            resolved.append(literal)
+        return "".join(resolved)
+
+class Row(object):
+    # One permutation of a template, kept as a reference to the template plus
+    # the tuple of slot values
+    __slots__ = ("testname", "template", "values", "resolved")
+
+    def __init__(self, testname, template, values):
+        self.testname = testname
+        self.template = template
+        self.values = values
+        self.resolved = template.resolve(values)
+
+    @property
+    def utterance(self):
+        return self.template.utterance
+
+    @property
+    def filepfx(self):
+        return self.resolved.replace(" ", "_").replace("'", "")
+
+    @property
+    def types(self):
+        return dict(zip(self.template.typenames, self.values))
+
+    def phrases(self, leadin):
+        # The spoken text split wherever a slot value meets the template's
+        # text at a word boundary.  A value that's part of a word stays with
+        # the rest of the word.
+        pieces = [leadin + self.template.literals[0]]
+        for pos, literal in zip(self.template.positions, self.template.literals[1:]):
+            pieces.append(self.values[pos])
+            pieces.append(literal)
+
+        phrases = []
+        current = ""
+        for piece in pieces:
+            if current and (current[-1].isspace() or piece[:1].isspace()):
+                phrases.append(current.strip())
+                current = ""
+            current += piece
+        phrases.append(current.strip())
+        return [phrase for phrase in phrases if phrase]
+
+class Plan(object):
+    # A test's resolved types and utterance templates, along with every row
+    # of its matrix, written by --compile so later runs can skip resolving.
+    # The plan is JSON lines: a header and then one line per row holding the
+    # index of each of its slot values.  The index file next to it gives the
+    # offset and number of each template's rows so any subset of templates
+    # can be read without touching the rest.  The plan is only used while
+    # the test file, the files it reads and the directories it refers to are
+    # unchanged.
+    VERSION = 1
+
+    def __init__(self, root, testpath):
+        name = "%s.%s.plan" % (os.path.basename(testpath),
+                               hashlib.sha1(os.path.abspath(testpath).encode("UTF-8")).hexdigest()[:8])
+        self.path = os.path.join(root, name)
+        self.indexpath = self.path + ".idx"
+        self.testpath = testpath
+        self.types = None
+        self.templates = None
+        self.positions = {}
+        self.offsets = []
+        self.counts = []
+
+    @staticmethod
+    def settings():
+        return [OPTS.skilldir, OPTS.testsdir, OPTS.cover]
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def write(self, sources, types, templates):
+        header = \
+        {
+            "version": Plan.VERSION,
+            "settings": Plan.settings(),
+            "sources": dict((path, Plan.stamp(path)) for path in [os.path.abspath(self.testpath)] + sorted(sources)),
+            "types": types,
+            "templates": [template.utterance for template in templates]
+        }
+
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        offsets = []
+        counts = []
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header).encode("UTF-8") + b"\n")
+            for template in templates:
+                offsets.append(f.tell())
+                counts.append(template.count(types))
+                for indexes in template.indexes(types):
+                    f.write(json.dumps(indexes, separators=(",", ":")).encode("ascii") + b"\n")
+
+        # The index goes last so a plan without one is never trusted
+        os.replace(tmp, self.path)
+        tmp = "%s.%d.tmp" % (self.indexpath, os.getpid())
+        with open(tmp, "wt") as f:
+            json.dump({"offsets": offsets, "counts": counts}, f)
+        os.replace(tmp, self.indexpath)
+
+        return sum(counts)
+
+    def load(self):
+        try:
+            with open(self.indexpath, "rt") as f:
+                index = json.load(f)
+            with open(self.path, "rb") as f:
+                header = json.loads(f.readline().decode("UTF-8"))
+        except (OSError, ValueError):
+            return False
+
+        if header.get("version") != Plan.VERSION or header.get("settings") != Plan.settings():
+            return False
+
+        for path, stamp in header["sources"].items():
+            if Plan.stamp(path) != stamp:
+                return False
+
+        self.types = header["types"]
+        self.templates = [Template(utterance) for utterance in header["templates"]]
+        self.positions = dict((id(template), ndx) for ndx, template in enumerate(self.templates))
+        self.offsets = index["offsets"]
+        self.counts = index["counts"]
+        return True
+
+    def rows(self, testname, templates):
+        # Jump straight to each template's rows
+        with open(self.path, "rb") as f:
+            for template in templates:
+                ndx = self.positions[id(template)]
+                f.seek(self.offsets[ndx])
+                values = [self.types[typename] for typename in template.typenames]
+                for _ in range(self.counts[ndx]):
+                    indexes = json.loads(f.readline().decode("ascii"))
+                    yield Row(testname, template, tuple(vals[i] for vals, i in zip(values, indexes)))
+
+class AudioCache(object):
+    # Voice input files are stored under a hash of everything that affects the
+    # generated audio, sharded by the first two hex digits of the hash.  An
+    # index in the root directory gives O(1) lookups and tracks usage so the
+    # least recently used files can be evicted when the cache grows too big.
+    def __init__(self, root, maxsize=0):
+        self.root = root
+        self.maxsize = maxsize * 1024 * 1024
+        self.indexpath = os.path.join(root, "index.json")
+        self.index = OrderedDict()
+        self.size = 0
+        self.started = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load()
+
+    @staticmethod
+    def key(text):
+        ident = TTS.signature() + [OPTS.invocation, text]
+        if OPTS.splice:
+            ident += ["splice", OPTS.splicegap, OPTS.splicefade, OPTS.trimdb, OPTS.trimpad]
+        ident += Conditioner.signature()
+        return hashlib.sha1(json.dumps(ident).encode("UTF-8")).hexdigest()
+
+    @staticmethod
+    def phrase_key(text):
+        ident = json.dumps(TTS.signature() + ["phrase", text])
+        return hashlib.sha1(ident.encode("UTF-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + ".wav")
+
+    def load(self):
+        if os.path.exists(self.indexpath):
+            try:
+                with open(self.indexpath, "rt") as f:
+                    entries = json.load(f)
+            except ValueError:
+                print("Audio cache index is damaged...rebuilding")
+                entries = {}
+
+            # Oldest first so the OrderedDict doubles as the LRU list
+            for key in sorted(entries, key=lambda k: entries[k]["used"]):
+                self.index[key] = entries[key]
+                self.size += entries[key]["size"]
+
+    def save(self):
+        self.evict()
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+        tmp = "%s.%d.tmp" % (self.indexpath, os.getpid())
+        with open(tmp, "wt") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.indexpath)
+
+    def lookup(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            # The file may have been copied in from another cache
+            path = self.path(key)
+            if os.path.exists(path):
+                self.add(key)
+                entry = self.index[key]
+
+        if entry is None:
+            self.misses += 1
+            METRICS.count("cache_misses")
+            return None
+
+        entry["used"] = time.time()
+        self.index.move_to_end(key)
+        self.hits += 1
+        METRICS.count("cache_hits")
+        return self.path(key)
+
+    def add(self, key, text=None):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+
+        if key in self.index:
+            self.size -= self.index.pop(key)["size"]
+
+        entry = {"size": os.path.getsize(path), "used": time.time()}
+        if text is not None:
+            entry["text"] = text
+        self.index[key] = entry
+        self.size += entry["size"]
+        return True
+
+    def evict(self):
+        if self.maxsize <= 0:
+            return
+
+        # Never evict anything used by this run since it may still be needed
+        while self.size > self.maxsize and len(self.index) > 0:
+            key, entry = next(iter(self.index.items()))
+            if entry["used"] >= self.started:
+                break
+
+            del self.index[key]
+            self.size -= entry["size"]
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def report(self):
+        print("Audio cache: %d hit(s), %d miss(es), %d eviction(s), %d file(s), %.1f MB" %
+              (self.hits, self.misses, self.evictions, len(self.index), self.size / 1048576.0))
+
+class Journal(object):
+    # Remembers which utterances AVS has already answered, keyed by a hash of
+    # everything that affects the answer.  Each response is appended as soon
+    # as it arrives, so an interrupted run picks up where it stopped.  Later
+    # lines for a key update earlier ones and the file is compacted when the
+    # test finishes.
+    def __init__(self, root):
+        self.path = os.path.join(root, "journal.jsonl")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.f = None
+        self.skipped = 0
+        self.recorded = 0
+        self.load()
+
+    @staticmethod
+    def key(text):
+        ident = json.dumps([AudioCache.key(text), OPTS.invocation, OPTS.locale, OPTS.skillversion])
+        return hashlib.sha1(ident.encode("UTF-8")).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rt") as f:
+            for line in f:
+                # The last line may be incomplete if the run was killed
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries.setdefault(entry["key"], {}).update(entry)
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+        # The response has to still be around to count
+        if entry is None or not os.path.exists(os.path.join(OPTS.outputdir, entry["mp3"])):
+            return None
+
+        self.skipped += 1
+        METRICS.count("unchanged")
+        return entry
+
+    def record(self, key, **fields):
+        fields["key"] = key
+        with self.lock:
+            # Replayed results don't need to be written again
+            entry = self.entries.get(key, {})
+            if all(entry.get(name) == value for name, value in fields.items()):
+                return
+
+            if self.f is None:
+                if not os.path.exists(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                self.f = open(self.path, "at")
+            self.entries.setdefault(key, {}).update(fields)
+            self.f.write(json.dumps(fields) + "\n")
+            self.f.flush()
+            self.recorded += 1
+
+    def close(self):
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.close()
+            self.f = None
+
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "wt") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp, self.path)
+
+    def report(self):
+        print("Journal: %d unchanged utterance(s) skipped, %d response(s) recorded" %
+              (self.skipped, self.recorded))
+
+class ResponseIndex(object):
+    # Groups a test's responses so each kind only needs to be listened to
+    # once.  Byte-identical responses are stored once, under their hash in
+    # the responses directory of the outputdir, with each response file a
+    # link to it.  Near-identical ones are clustered by fingerprint and each
+    # cluster's first response is linked into the test's clusters directory
+    # along with a mapping of the members.  Fingerprints are kept by hash in
+    # fingerprints.json, so each distinct response is only decoded once.
+    CHUNK = 64
+
+    def __init__(self, root, testname):
+        self.root = root
+        self.path = os.path.join(root, "fingerprints.json")
+        self.clusterdir = os.path.join(root, "clusters", os.path.basename(testname))
+        self.lock = threading.Lock()
+        self.prints = {}
+        self.responses = []
+        self.hashes = {}
+        self.shared = 0
+        self.clusters = []
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rt") as f:
+                entries = json.load(f)
+        except ValueError:
+            return
+        for sha1, entry in entries.items():
+            if entry is not None:
+                entry = (entry[0], np.frombuffer(base64.b64decode(entry[1]), dtype=np.float16))
+            self.prints[sha1] = entry
+
+    def save(self):
+        entries = {}
+        for sha1, entry in self.prints.items():
+            if entry is not None:
+                entry = [entry[0], base64.b64encode(entry[1].tobytes()).decode("ascii")]
+            entries[sha1] = entry
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wt") as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
+
+    def add(self, row, mp3):
+        with self.lock:
+            self.responses.append((row, mp3))
+
+    def finish(self, batch, tally):
+        # Hash and fingerprint the responses in the TTS pool
+        paths = list(OrderedDict.fromkeys(mp3 for _, mp3 in self.responses))
+        sizes = {}
+
+        def callback(chunk):
+            def collect(future):
+                if future.exception() is not None:
+                    return
+                entries, stats = future.result()
+                tally(stats)
+                with self.lock:
+                    for mp3, entry in zip(chunk, entries):
+                        if entry is None:
+                            continue
+                        sha1, size, fingerprint = entry
+                        self.hashes[mp3] = sha1
+                        sizes[mp3] = size
+                        if sha1 not in self.prints or self.prints[sha1] is None:
+                            self.prints[sha1] = fingerprint
+            return collect
+
+        known = set(self.prints)
+        for ndx in range(0, len(paths), ResponseIndex.CHUNK):
+            chunk = paths[ndx:ndx + ResponseIndex.CHUNK]
+            batch.submit(run_fingerprint, [os.path.join(self.root, mp3) for mp3 in chunk], known,
+                         callback=callback(chunk))
+        batch.join()
+        self.save()
+
+        for mp3 in paths:
+            if mp3 in self.hashes:
+                self.share(mp3, self.hashes[mp3], sizes[mp3])
+        self.prune()
+        self.cluster()
+        self.write()
+
+    def share(self, mp3, sha1, size):
+        # Link the response to the one stored copy of its audio
+        path = os.path.join(self.root, mp3)
+        blob = os.path.join(self.root, "responses", sha1[:2], sha1 + ".mp3")
+        try:
+            if not os.path.exists(blob):
+                if not os.path.exists(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                os.link(path, blob)
+            elif not os.path.samefile(path, blob):
+                tmp = "%s.%d.tmp" % (path, os.getpid())
+                os.link(blob, tmp)
+                os.replace(tmp, path)
+                self.shared += size
+        except OSError:
+            # Links aren't supported here, so every response keeps its own copy
+            pass
+
+    def prune(self):
+        # Stored audio no response links to any more
+        for dirpath, _, names in os.walk(os.path.join(self.root, "responses")):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+
+    def cluster(self):
+        # Each distinct response joins the most similar cluster of about the
+        # same length, if it's similar enough, or starts a new one.  Responses
+        # that couldn't be decoded only go with the same bytes.
+        distinct = list(OrderedDict.fromkeys(self.hashes[mp3] for _, mp3 in self.responses
+                                             if mp3 in self.hashes))
+        size = Fingerprint.BANDS * Fingerprint.STEPS
+        vectors = np.zeros((len(distinct), size), dtype=np.float32)
+        durations = np.full(len(distinct), -1e9)
+        leaders = []
+        assigned = {}
+        for sha1 in distinct:
+            entry = self.prints.get(sha1)
+            count = len(leaders)
+            if entry is not None and count:
+                duration, vector = entry
+                similarity = vectors[:count] @ vector.astype(np.float32)
+                similarity[np.abs(durations[:count] - duration) > 0.2 * duration] = -1.0
+                best = int(np.argmax(similarity))
+                if similarity[best] >= OPTS.similarity:
+                    assigned[sha1] = (best, float(similarity[best]))
+                    continue
+            if entry is not None:
+                durations[count] = entry[0]
+                vectors[count] = entry[1]
+            leaders.append(sha1)
+            assigned[sha1] = (count, 1.0)
+
+        members = [[] for _ in leaders]
+        for row, mp3 in self.responses:
+            if mp3 in self.hashes:
+                ndx, similarity = assigned[self.hashes[mp3]]
+                members[ndx].append((row, mp3, self.hashes[mp3], similarity))
+
+        # Biggest first, since they save the most listening
+        self.clusters = sorted((m for m in members if m), key=lambda m: -len(m))
+
+    def write(self):
+        if os.path.exists(self.clusterdir):
+            shutil.rmtree(self.clusterdir)
+        os.makedirs(self.clusterdir)
+
+        mapping = []
+        for num, members in enumerate(self.clusters, 1):
+            row, mp3, sha1, _ = members[0]
+            name = "%04d_%s" % (num, os.path.basename(mp3))
+            try:
+                os.link(os.path.join(self.root, mp3), os.path.join(self.clusterdir, name))
+            except OSError:
+                shutil.copyfile(os.path.join(self.root, mp3), os.path.join(self.clusterdir, name))
+            mapping.append({"cluster": num,
+                            "representative": name,
+                            "members": [{"utterance": row.resolved,
+                                         "response": mp3,
+                                         "sha1": sha1,
+                                         "similarity": round(similarity, 3)}
+                                        for row, mp3, sha1, similarity in members]})
+
+        with open(os.path.join(self.clusterdir, "clusters.json"), "wt") as f:
+            json.dump(mapping, f, indent=4)
+
+    def report(self):
+        print("Responses: %d file(s), %d distinct, %d cluster(s), %.1f MB shared, clusters in %s" %
+              (len(self.hashes), len(set(self.hashes.values())), len(self.clusters),
+               self.shared / 1048576.0, self.clusterdir))
+
+class ResultsStore(object):
+    # Every run's results in one SQLite database: a row per run, per test and
+    # per utterance, along with the utterance's slot values and, by content
+    # hash, AVS's response audio.  Updates come from the pool callbacks as
+    # responses arrive, so they're gathered up and written a batch at a time,
+    # each batch in a single transaction.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            started REAL,
+            finished REAL,
+            argv TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tests (
+            id INTEGER PRIMARY KEY,
+            run INTEGER REFERENCES runs(id),
+            name TEXT,
+            started REAL,
+            finished REAL,
+            permutations INTEGER,
+            settings TEXT
+        );
+        CREATE TABLE IF NOT EXISTS utterances (
+            id INTEGER PRIMARY KEY,
+            test INTEGER REFERENCES tests(id),
+            utterance TEXT,
+            resolved TEXT,
+            status TEXT,
+            sent REAL,
+            elapsed REAL,
+            response TEXT,
+            message TEXT,
+            unittest TEXT,
+            UNIQUE (test, resolved)
+        );
+        CREATE TABLE IF NOT EXISTS slots (
+            utterance INTEGER REFERENCES utterances(id),
+            type TEXT,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS audio (
+            hash TEXT PRIMARY KEY,
+            size INTEGER,
+            data BLOB
+        );
+        CREATE INDEX IF NOT EXISTS utterances_status ON utterances (status);
+        CREATE INDEX IF NOT EXISTS utterances_resolved ON utterances (resolved);
+        CREATE INDEX IF NOT EXISTS slots_type_value ON slots (type, value);
+        CREATE INDEX IF NOT EXISTS slots_utterance ON slots (utterance);
+        CREATE INDEX IF NOT EXISTS tests_run ON tests (run);
+    """
+
+    FIELDS = ("utterance", "status", "sent", "elapsed", "response", "message", "unittest")
+
+    BATCH = 500
+
+    # Canned queries for --query, anything else is run as SQL
+    QUERIES = \
+    {
+        "runs": """
+            SELECT runs.id AS run, datetime(runs.started, 'unixepoch', 'localtime') AS started,
+                   count(utterances.id) AS utterances,
+                   sum(utterances.status IN ('answered', 'passed', 'unchanged')) AS ok,
+                   sum(utterances.status IN ('error', 'failed', 'nomessage')) AS failed,
+                   round(avg(utterances.elapsed), 2) AS avg_secs
+            FROM runs LEFT JOIN tests ON tests.run = runs.id
+                      LEFT JOIN utterances ON utterances.test = tests.id
+            GROUP BY runs.id ORDER BY runs.id
+        """,
+        "failures": """
+            SELECT tests.name AS test, utterances.status, utterances.resolved
+            FROM utterances JOIN tests ON tests.id = utterances.test
+            WHERE tests.run = (SELECT max(id) FROM runs)
+              AND utterances.status IN ('error', 'failed', 'nomessage')
+            ORDER BY tests.name, utterances.resolved
+        """,
+        "slots": """
+            SELECT slots.type, slots.value, count(*) AS utterances,
+                   sum(utterances.status IN ('error', 'failed', 'nomessage')) AS failed
+            FROM slots JOIN utterances ON utterances.id = slots.utterance
+                       JOIN tests ON tests.id = utterances.test
+            WHERE tests.run = (SELECT max(id) FROM runs)
+            GROUP BY slots.type, slots.value
+            ORDER BY failed DESC, slots.type, slots.value
+        """,
+        "slowest": """
+            SELECT tests.name AS test, round(utterances.elapsed, 2) AS secs, utterances.resolved
+            FROM utterances JOIN tests ON tests.id = utterances.test
+            WHERE tests.run = (SELECT max(id) FROM runs) AND utterances.elapsed IS NOT NULL
+            ORDER BY utterances.elapsed DESC LIMIT 20
+        """
+    }
+
+    def __init__(self, path, audio=False):
+        self.path = os.path.expanduser(path)
+        self.audio = audio
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.run = None
+        self.test = None
+        self.seen = set()
+        self.written = 0
+
+        if os.path.dirname(self.path) and not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(ResultsStore.SCHEMA)
+
+    def start_test(self, testname, permutations):
+        with self.lock:
+            if self.run is None:
+                cur = self.db.execute("INSERT INTO runs (started, argv) VALUES (?, ?)",
+                                      (time.time(), json.dumps(sys.argv[1:])))
+                self.run = cur.lastrowid
+            cur = self.db.execute("INSERT INTO tests (run, name, started, permutations, settings) VALUES (?, ?, ?, ?, ?)",
+                                  (self.run, testname, time.time(), permutations,
+                                   json.dumps(TTS.signature() + [OPTS.invocation, OPTS.locale, OPTS.skillversion])))
+            self.db.commit()
+            self.test = cur.lastrowid
+            self.seen = set()
+
+    def record(self, row, **fields):
+        # Later updates to an utterance are merged into any still waiting
+        with self.lock:
+            entry = self.pending.get(row.resolved)
+            if entry is None:
+                entry = self.pending[row.resolved] = {"row": row}
+            entry.update(fields)
+            if len(self.pending) >= ResultsStore.BATCH:
+                self.flush()
+
+    def response(self, path):
+        # Responses are referred to by the hash of their audio, which is only
+        # stored once however many utterances got it
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO audio (hash, size, data) VALUES (?, ?, ?)",
+                            (digest, len(data), sqlite3.Binary(data) if self.audio else None))
+        return digest
+
+    def flush(self):
+        # Called with the lock held
+        if not self.pending:
+            return
+
+        entries = list(self.pending.values())
+        self.pending = OrderedDict()
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO utterances (test, resolved, %s) VALUES (?, ?, %s) "
+                "ON CONFLICT (test, resolved) DO UPDATE SET %s" %
+                (", ".join(ResultsStore.FIELDS),
+                 ", ".join("?" * len(ResultsStore.FIELDS)),
+                 ", ".join("%s = coalesce(excluded.%s, %s)" % (f, f, f) for f in ResultsStore.FIELDS)),
+                [[self.test, entry["row"].resolved, entry["row"].utterance] +
+                 [ResultsStore.value(entry.get(f)) for f in ResultsStore.FIELDS[1:]]
+                 for entry in entries])
+
+            # Slot values only need writing the first time
+            slots = []
+            for entry in entries:
+                row = entry["row"]
+                if row.resolved in self.seen:
+                    continue
+                self.seen.add(row.resolved)
+                for typename, value in row.types.items():
+                    slots.append((typename.strip("{}"), value, self.test, row.resolved))
+            self.db.executemany("INSERT INTO slots (utterance, type, value) "
+                                "SELECT id, ?, ? FROM utterances WHERE test = ? AND resolved = ?", slots)
+        self.written += len(entries)
+
+    @staticmethod
+    def value(value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+
+    def finish_test(self):
+        with self.lock:
+            self.flush()
+            if self.test is not None:
+                with self.db:
+                    self.db.execute("UPDATE tests SET finished = ? WHERE id = ?", (time.time(), self.test))
+            self.test = None
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.run is not None:
+                with self.db:
+                    self.db.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run))
+            self.db.close()
+
+    def report(self):
+        print("Results store: %d utterance update(s) written to %s, run %s" %
+              (self.written, self.path, self.run))
+
+    def query(self, sql):
+        cur = self.db.execute(ResultsStore.QUERIES.get(sql, sql))
+        if cur.description is None:
+            self.db.commit()
+            return
+
+        names = [d[0] for d in cur.description]
+        rows = [["" if v is None else str(v) for v in row] for row in cur.fetchall()]
+        widths = [max([len(name)] + [len(row[n]) for row in rows]) for n, name in enumerate(names)]
+        print("  ".join(name.ljust(width) for name, width in zip(names, widths)))
+        print("  ".join("-" * width for width in widths))
+        for row in rows:
+            print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+        print()
+        print("%d row(s)" % len(rows))
+
+class ValueCache(object):
+    # Values produced by the file and exec methods, shared by every test in
+    # the run.  File values are keyed by the file's path, size and mtime and
+    # exec values by the command, working directory and environment.  They
+    # may also be kept on disk, but exec values are only reused by later runs
+    # for ttl seconds since a command can give different answers over time.
+    def __init__(self, path=None, ttl=0):
+        self.path = os.path.expanduser(path) if path else None
+        self.ttl = ttl
+        self.entries = {}
+        self.started = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "rt") as f:
+                self.entries = json.load(f)
+        except ValueError:
+            print("Value cache is damaged...ignoring it")
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+
+        # Don't keep exec values nobody will be allowed to use
+        for key in [key for key, entry in self.entries.items() if not self.fresh(entry)]:
+            del self.entries[key]
+
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wt") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    def fresh(self, entry):
+        if entry["kind"] == "file" or entry["time"] >= self.started:
+            return True
+        return self.ttl > 0 and time.time() - entry["time"] < self.ttl
+
+    @staticmethod
+    def file_key(path, utterances):
+        st = os.stat(path)
+        return json.dumps(["file", os.path.abspath(path), utterances, st.st_size, st.st_mtime_ns])
+
+    @staticmethod
+    def exec_key(cmd):
+        env = hashlib.sha1(json.dumps(sorted(os.environ.items())).encode("UTF-8")).hexdigest()
+        return json.dumps(["exec", cmd, os.getcwd(), env])
+
+    def get(self, key, kind, source, produce):
+        entry = self.entries.get(key)
+        if entry is not None and self.fresh(entry):
+            self.hits += 1
+            return entry["values"]
+
+        self.misses += 1
+        values = produce()
+
+        # An edited file replaces what was cached for it
+        if kind == "file":
+            for old in [k for k, e in self.entries.items() if e.get("source") == source]:
+                del self.entries[old]
+
+        self.entries[key] = {"kind": kind, "source": source, "time": time.time(), "values": values}
+        self.dirty = True
+        return values
+
+    def report(self):
+        print("Value cache: %d hit(s), %d miss(es)" % (self.hits, self.misses))
+
+class FileLock(object):
+    # Exclusive lock shared by every process using the same path
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+        self.f = None
+
+class TokenCache(object):
+    # AVS access and refresh tokens kept in a file so every worker process
+    # (and later runs) can share them.  Tokens are refreshed shortly before
+    # they expire and the full login is only done if refreshing fails.
+    MARGIN = 120
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path) if path else None
+        self.lock = FileLock(self.path) if self.path else None
+        self.mutex = threading.Lock()
+        self.tokens = None
+
+    @staticmethod
+    def ident():
+        # Tokens are only good for the account and device that requested them
+        ident = json.dumps([OPTS.email, OPTS.clientid, OPTS.deviceid])
+        return hashlib.sha1(ident.encode("UTF-8")).hexdigest()
+
+    def usable(self, tokens):
+        return tokens is not None and \
+               tokens.get("ident") == self.ident() and \
+               tokens["expires"] - TokenCache.MARGIN > time.time()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return self.tokens
+        try:
+            with open(self.path, "rt") as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def save(self, tokens):
+        if self.path is None:
+            return
+
+        # Only the owner may read the tokens
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wt") as f:
+            json.dump(tokens, f)
+        os.replace(tmp, self.path)
+
+    def access(self, avs, rejected=None):
+        # Fast path, no locking or file access
+        tokens = self.tokens
+        if self.usable(tokens) and tokens["access"] != rejected:
+            return tokens["access"]
+
+        # Threads of the async engine share this instance
+        with self.mutex:
+            tokens = self.tokens
+            if self.usable(tokens) and tokens["access"] != rejected:
+                return tokens["access"]
+
+            if self.lock is None:
+                return self.use(self.renew(avs, tokens))
+
+            with self.lock:
+                # Another process may have already renewed them
+                tokens = self.load()
+                if not self.usable(tokens) or tokens["access"] == rejected:
+                    tokens = self.renew(avs, tokens)
+                    if tokens is not None:
+                        self.save(tokens)
+            return self.use(tokens)
+
+    def renew(self, avs, tokens):
+        if tokens is not None and tokens.get("ident") == self.ident():
+            renewed = avs.refresh(tokens["refresh"])
+            if renewed is not None:
+                return renewed
+        return avs.auth()
+
+    def use(self, tokens):
+        self.tokens = tokens
+        if tokens is None:
+            return None
+        OPTS.access = tokens["access"]
+        return OPTS.access
+
+def get_tokens():
+    global TOKENS
+
+    if TOKENS is None or TOKENS.path != (os.path.expanduser(OPTS.tokencache) if OPTS.tokencache else None):
+        TOKENS = TokenCache(OPTS.tokencache)
+
+    return TOKENS
+
+class Expected(object):
+    # An utterance sent to AVS that a results message is expected for
+    __slots__ = ("seq", "row", "sent", "done", "dropped")
+
+    def __init__(self, seq, row):
+        self.seq = seq
+        self.row = row
+        self.sent = time.time()
+        self.done = None
+
+        # A message that could have been this one's was dropped
+        self.dropped = False
+
+class ResultsQueue(object):
+    # Reads the results messages the skill writes to SQS on a background
+    # thread, long polling for up to 10 at a time and deleting them in
+    # batches.  Since many utterances may be in flight at once, each message
+    # is matched to the utterance whose slot values agree with the ones in the
+    # skill's event.  A message that doesn't clearly belong to one of them is
+    # never guessed at.  It's counted as unmatched and, from then on, the test
+    # only has one utterance waiting on its message at a time, which is also
+    # how tests whose utterances can't be told apart are run from the start.
+    # Utterances whose message may have been the one dropped are sent again,
+    # one at a time, once the rest are done.
+    def __init__(self, queueurl):
+        self.queueurl = queueurl
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.serial = False
+        self.resending = False
+        self.resend = []
+        self.expected = OrderedDict()
+        self.results = queue.Queue()
+        self.seq = 0
+        self.received = 0
+        self.unmatched = 0
+        self.timedout = 0
+        self.ambiguous = 0
+
+    def drain(self):
+        # Shouldn't be necessary, but clear the queue
+        # (don't use purge_queue as if forces a 60 second delay between runs)
+        while True:
+            msgs = self.receive(1)
+            if len(msgs) == 0:
+                break
+
+    @timed("sqs")
+    def receive(self, wait):
+        resp = get_sqs().receive_message(QueueUrl=self.queueurl,
+                                         MaxNumberOfMessages=10,
+                                         WaitTimeSeconds=wait)
+        if resp is None or "Messages" not in resp:
+            return []
+
+        msgs = resp["Messages"]
+        get_sqs().delete_message_batch(QueueUrl=self.queueurl,
+                                       Entries=[{"Id": str(ndx), "ReceiptHandle": msg["ReceiptHandle"]}
+                                                for ndx, msg in enumerate(msgs)])
+        return msgs
+
+    def start(self):
+        self.drain()
+        self.thread = threading.Thread(target=self.consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def finish(self):
+        # Wait for every expected message to arrive or time out.  Once sqswait
+        # has passed since the last utterance was answered nothing more is
+        # coming, even if SQS has stopped answering the background thread.
+        while True:
+            now = time.time()
+            with self.lock:
+                if len(self.expected) == 0:
+                    return
+                if now - max(e.done or e.sent for e in self.expected.values()) > OPTS.sqswait:
+                    self.expire(now, everything=True)
+                    return
+            time.sleep(0.1)
+
+    def settled(self):
+        # Whether the next utterance may be sent
+        with self.lock:
+            self.expire(time.time())
+            return not self.serial or len(self.expected) == 0
+
+    def settle(self):
+        # When utterances go one at a time, wait for the last one's message
+        # to arrive or time out
+        with self.changed:
+            while self.serial and len(self.expected) > 0:
+                self.expire(time.time())
+                if len(self.expected) > 0:
+                    self.changed.wait(0.1)
+
+    def expect(self, row):
+        self.settle()
+        with self.lock:
+            self.seq += 1
+            expected = Expected(self.seq, row)
+            self.expected[expected.seq] = expected
+        return expected
+
+    def done(self, expected):
+        expected.done = time.time()
+
+    def replay(self, row, er):
+        # A results message saved by an earlier run
+        self.results.put((row, er))
+
+    def matched(self):
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+    def consume(self):
+        while not self.stopping.is_set():
+            try:
+                msgs = self.receive(5)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(1)
+                with self.lock:
+                    self.expire(time.time())
+                continue
+
+            now = time.time()
+            with self.lock:
+                for msg in msgs:
+                    self.received += 1
+                    self.match(msg, now)
+                self.expire(now)
+
+    def match(self, msg, received):
+        # Attempt to parse it
+        try:
+            er = json.loads(msg["Body"])
+        except ValueError:
+            print("Parsing results message failed")
+            self.unmatched += 1
+            return
+
+        # Make sure we have both the event and response dicts
+        if not isinstance(er, dict) or "event" not in er or "response" not in er:
+            print("Results message missing event/response dict")
+            self.unmatched += 1
+            return
+
+        # Only utterances sent before the message arrived could have caused it
+        candidates = [e for e in self.expected.values() if e.sent <= received]
+        if len(candidates) == 0:
+            print("Results message doesn't match any utterance...dropping")
+            self.unmatched += 1
+            return
+
+        # With more than one candidate, only a best match that's backed by
+        # slot values and shared with no other utterance will do
+        slots = self.slots(er)
+        best = candidates[0]
+        if len(candidates) > 1:
+            scores = dict((e.seq, self.score(e.row, slots)) for e in candidates)
+            top = max(scores.values())
+            tied = [e for e in candidates if scores[e.seq] == top]
+            if top <= 0 or len(tied) > 1:
+                print("Results message agrees equally well with %d utterances...dropping" % len(tied))
+                self.unmatched += 1
+                self.ambiguous += 1
+                for e in tied:
+                    e.dropped = True
+                self.one_at_a_time()
+                return
+            best = tied[0]
+
+        # Types that aren't slots of the skill can't tell utterances apart
+        missing = [typename for typename in best.row.template.typenames if typename.strip("{}") not in slots]
+        if len(missing) > 0 and not self.serial:
+            print("%s not slot(s) in the skill's event" % ", ".join(missing))
+            self.one_at_a_time()
+
+        del self.expected[best.seq]
+        self.changed.notify_all()
+        self.results.put((best.row, er))
+
+    def resends(self):
+        # The utterances to send again, one at a time, and only once
+        with self.lock:
+            rows = self.resend
+            self.resend = []
+            self.serial = True
+            self.resending = True
+        return rows
+
+    def one_at_a_time(self):
+        if not self.serial:
+            print("Sending one utterance at a time from now on")
+            self.serial = True
+
+    def expire(self, now, everything=False):
+        for expected in list(self.expected.values()):
+            if everything or (expected.done is not None and now - expected.done > OPTS.sqswait):
+                del self.expected[expected.seq]
+                if expected.dropped and not self.resending:
+                    self.resend.append(expected.row)
+                else:
+                    self.timedout += 1
+                    self.results.put((expected.row, None))
+                self.changed.notify_all()
+
+    @staticmethod
+    def slots(er):
+        try:
+            slots = er["event"]["request"]["intent"]["slots"]
+        except (KeyError, TypeError):
+            return {}
+
+        return dict((name, ResultsQueue.normal(str(slot.get("value", ""))))
+                    for name, slot in slots.items() if isinstance(slot, dict))
+
+    @staticmethod
+    def normal(value):
+        # Case, spacing and punctuation aren't reliably the same in the skill's
+        # event, and --digits spells numbers out one digit at a time
+        return re.sub(r"[\W_]+", "", value.lower())
+
+    @staticmethod
+    def score(row, slots):
+        # Slots the skill filled differently count against the utterance, so
+        # one whose slots are a superset of another's doesn't tie with it
+        score = 0
+        for typename, value in zip(row.template.typenames, row.values):
+            name = typename.strip("{}")
+            if name in slots:
+                score += 1 if slots[name] == ResultsQueue.normal(value) else -1
+        return score
+
+    @staticmethod
+    def distinguishable(templates, types):
+        # Every utterance needs slot values and no two may have the same ones,
+        # otherwise a message could belong to any of them.  A template's rows
+        # are combinations of its types' values, so it's enough to check the
+        # values of each type and that no two templates use the same types.
+        seen = set()
+        for template in templates:
+            names = frozenset(template.typenames)
+            if len(names) == 0 or names in seen:
+                return False
+            seen.add(names)
+            for typename in names:
+                values = [ResultsQueue.normal(value) for value in types[typename]]
+                if len(set(values)) != len(values):
+                    return False
+        return True
+
+    def report(self):
+        print("Results: %d message(s) received, %d unmatched (%d ambiguous), %d utterance(s) timed out" %
+              (self.received, self.unmatched, self.ambiguous, self.timedout))
+
+# The unit test module loaded by each unit test worker
+UNITTEST = None
+
+def unit_load(path, argv):
+    global UNITTEST
+
+    worker_init()
+
+    # Load it under a name other than __main__ so it doesn't run itself
+    loader = importlib.machinery.SourceFileLoader("skilltest_unittest", path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    sys.argv = [path] + argv
+    loader.exec_module(module)
+    UNITTEST = module
+
+def unit_import(data):
+    # The tests find their input in the module's DATA global, just as when
+    # the module is run with the input on stdin
+    with Timer("unittest"):
+        UNITTEST.DATA = data
+        suite = unittest.defaultTestLoader.loadTestsFromModule(UNITTEST)
+        stream = io.StringIO()
+        result = unittest.TextTestRunner(stream=stream).run(suite)
+    return result.wasSuccessful(), stream.getvalue(), {"metrics": METRICS.take()}
+
+def unit_shell(command, data):
+    with Timer("unittest"):
+        p = Popen(command, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        _, err = p.communicate(json.dumps(data).encode("UTF-8"))
+    return p.returncode == 0, err.decode("UTF-8"), {"metrics": METRICS.take()}
+
+class UnitRunner(object):
+    # Runs the unit test for each utterance on a small pool so checking
+    # results stays off the critical path.  In "import" mode, a Python unit
+    # test is loaded once by each worker process and fed every payload,
+    # otherwise the command is run once per utterance.
+    def __init__(self, command, store=None):
+        self.command = command
+        self.store = store
+        self.pending = set()
+        self.passed = 0
+        self.failed = 0
+
+        path, argv = self.module(command) if OPTS.unitmode == "import" else (None, None)
+        if path is not None:
+            self.executor = ProcessPoolExecutor(max_workers=OPTS.unittasks,
+                                                initializer=unit_load,
+                                                initargs=(path, argv))
+        else:
+            if OPTS.unitmode == "import":
+                print("Unit test isn't a Python script...running it for each utterance")
+            self.executor = ThreadPoolExecutor(max_workers=OPTS.unittasks)
+
+    @staticmethod
+    def module(command):
+        # Only "python script [args]" style commands can be imported
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            return None, None
+        if len(argv) < 2 or not os.path.basename(argv[0]).startswith("python"):
+            return None, None
+        if not os.path.isfile(argv[1]):
+            return None, None
+        return argv[1], argv[2:]
+
+    def submit(self, row, data):
+        if isinstance(self.executor, ProcessPoolExecutor):
+            future = self.executor.submit(unit_import, data)
+        else:
+            future = self.executor.submit(unit_shell, self.command, data)
+        future.row = row
+        self.pending.add(future)
+
+    def collect(self, block=False):
+        if block:
+            done, self.pending = wait(self.pending)
+        else:
+            done = set(future for future in self.pending if future.done())
+            self.pending -= done
+
+        for future in done:
+            try:
+                passed, output, stats = future.result()
+                METRICS.add(stats)
+            except Exception:
+                passed, output = False, traceback.format_exc()
+
+            if passed:
+                self.passed += 1
+            else:
+                self.failed += 1
+            if self.store is not None:
+                self.store.record(future.row, status="passed" if passed else "failed", unittest=output)
+
+            print("Checking:   ", future.row.resolved)
+            leader = "Unittest:   "
+            output = output.replace("\r\n", "\n").replace("\r", "\n")
+            for line in output.split("\n"):
+                print("%s %s" % (leader, line))
+                leader = " " * 12
+
+    def close(self):
+        self.collect(block=True)
+        self.executor.shutdown(wait=True)
+
+    def report(self):
+        print("Unit tests: %d utterance(s) passed, %d failed...%s" %
+              (self.passed, self.failed, "FAILED" if self.failed else "OK"))
+
 class Options(object):
     def __init__(self):
         setattr(self, "file", None)
+        setattr(self, "count", False)
+        setattr(self, "refresh", False)
+        setattr(self, "compile", False)
+        setattr(self, "filter", None)
         self.merge_dict(CFG)
 
     def load_config(self, path):
@@ -142,7 +2318,7 @@ class Tester(object):
 
         sp = subpar.add_parser("file", parents=[shared])
         sp.add_argument("--utterances", default=False, action=("store_true"))
-        sp.add_argument("path", type=argparse.FileType("r"))
+        sp.add_argument("path", type=str)
         sp.set_defaults(func=Tester.handle_file)
 
         sp = subpar.add_parser("exec", parents=[shared])
@@ -153,22 +2329,125 @@ class Tester(object):
         sp.add_argument("text", type=str)
         sp.set_defaults(func=Tester.handle_text)
 
+        self.runner = None
+        self.journal = None
+        self.throttle = None
+        self.responses = None
+        self.compiled = None
+        self.sources = set()
+        self.matrix = 0
+        self.audio = AudioStats()
+        self.metrics = Metrics()
+        self.started = datetime.now().isoformat(timespec="seconds")
+        if OPTS.profile:
+            root = os.path.join(OPTS.outputdir, "profile")
+            for name in os.listdir(root) if os.path.isdir(root) else []:
+                if name.startswith(OPTS.profile + "."):
+                    os.remove(os.path.join(root, name))
+        self.store = ResultsStore(OPTS.resultsdb, OPTS.resultsaudio) if OPTS.resultsdb else None
+        self.scheduler = Scheduler(OPTS.ttstasks, OPTS.avstasks)
+
+        # Parsed directives and the values they produced, for the whole run
+        self.parsed = {}
+        self.values = ValueCache(OPTS.valuecache, OPTS.valuettl)
+
+    def locate(self, testname):
+        if os.path.exists(testname):
+            return testname
+
+        path = os.path.join(OPTS.testsdir, testname)
+        if os.path.exists(path):
+            return path
+
+        return None
+
+    def plan(self, testnames):
+        # Size the shared pools for the busiest of the tests
+        ttstasks = OPTS.ttstasks
+        avstasks = max(OPTS.avstasks, OPTS.avsmax) if OPTS.adaptive else OPTS.avstasks
+        for testname in testnames:
+            path = self.locate(testname)
+            if path is None:
+                continue
+
+            try:
+                with open(path) as f:
+                    config = json.load(f).get("config", {})
+            except (ValueError, AttributeError):
+                continue
+
+            tts = config.get("ttstasks", OPTS.ttstasks)
+            avs = config.get("avstasks", OPTS.avstasks)
+            if config.get("adaptive", OPTS.adaptive):
+                avs = max(avs, config.get("avsmax", OPTS.avsmax))
+            if config.get("handoff", OPTS.handoff) == "memory":
+                avs = max(tts, avs)
+            ttstasks = max(ttstasks, tts)
+            avstasks = max(avstasks, avs)
+
+        self.scheduler = Scheduler(ttstasks, avstasks)
+
+    def close(self):
+        self.scheduler.close()
+
+        if self.audio.clips:
+            print()
+            self.audio.report()
+
+        self.metrics.merge(METRICS.take())
+        if self.metrics.stages:
+            print()
+            print("=" * 80)
+            print("Stage timings")
+            print("=" * 80)
+            print()
+            self.metrics.report()
+            self.write_metrics(self.metrics)
+
+        if OPTS.profile:
+            print()
+            dump_profile()
+            report_profile()
+
+        if self.store is not None:
+            if self.store.run is not None:
+                print()
+                self.store.report()
+            self.store.close()
+
+        if self.values.hits or self.values.misses:
+            print()
+            self.values.report()
+        self.values.save()
+
     def process(self, testname):
         global OPTS
 
+        # Tests run one after another rather than feeding the shared pools
+        # together.  A test's setup changes the skill's state for the
+        # utterances that follow it and its cleanup puts it back, so the next
+        # test's setup mustn't reach AVS until every utterance of this one has
+        # been answered and its cleanup has run.  Results messages are matched
+        # within a test as well, so two tests' utterances can't be in flight
+        # at once.  Jobs carry their own options, but the main process only
+        # ever works on one test, so its cache keys and callbacks read that
+        # test's options from OPTS, which is swapped in here and put back.
+
         # Locate the test file
-        if os.path.exists(testname):
-            path = testname
-        else:
-            path = os.path.join(OPTS.testsdir, testname)
-            if not os.path.exists(path):
-                print("Unable to locate test:", testname)
-                return
- 
+        path = self.locate(testname)
+        if path is None:
+            print("Unable to locate test:", testname)
+            return 0
+
         # Preserve options
         savedopts = deepcopy(OPTS)
+        try:
+            return self.run_test(testname, path)
+        finally:
+            # Restore options
+            OPTS = deepcopy(savedopts)
 
-        tests = []
+    def run_test(self, testname, path):
         with open(path) as f:
             print()
             print("#" * 80)
@@ -178,204 +2457,716 @@ class Tester(object):
             # Load the test
             test = json.load(f)
 
-            # Merge any embedded config options
-            if "config" in test:
-                OPTS.merge_dict(test["config"])
-
-            # Using the response queue?
-            if "unittest" in test or OPTS.keep:
-                # Make sure we can do it
-                if OPTS.queueurl is None:
-                    print("SQS queue URL needed if unit testing or keeping results...disabling")
-                    test["unittest"] = None
-                    OPTS.keep = False
-                else:
-                    # Must single thread AVS if unit testing or keeping results
-                    OPTS.avstasks = 1
+        # Merge any embedded config options
+        if "config" in test:
+            OPTS.merge_dict(test["config"])
 
-                    # Shouldn't be necessary, but clear the queue
-                    # (don't use purge_queue as if forces a 60 second delay between runs)
-                    while True:
-                        resp = SQS.receive_message(QueueUrl=OPTS.queueurl, WaitTimeSeconds=1)
-                        if resp is None or "Messages" not in resp:
-                            break
-                        SQS.delete_message(QueueUrl=OPTS.queueurl, ReceiptHandle=resp["Messages"][0]["ReceiptHandle"])
+        # Using the response queue?
+        if ("unittest" in test or OPTS.keep) and not OPTS.count and not OPTS.compile:
+            # Make sure we can do it
+            if OPTS.queueurl is None:
+                print("SQS queue URL needed if unit testing or keeping results...disabling")
+                test.pop("unittest", None)
+                OPTS.keep = False
 
+        print()
+        print("=" * 80)
+        print("Resolving utterances")
+        print("=" * 80)
+        print()
+
+        # A compiled plan saves resolving everything again
+        self.compiled = None
+        plan = Plan(OPTS.plandir, path)
+        if not OPTS.compile and plan.load():
+            print("Using compiled plan:", plan.path)
+            print()
+            self.compiled = plan
+            types = plan.types
+            templates = plan.templates
+        else:
+            self.sources = set()
+            types = self.resolve_types(test)
+            templates = self.compile_templates(test)
+
+        # Only work with some of the utterances
+        if OPTS.filter:
+            rx = re.compile(OPTS.filter)
+            templates = [template for template in templates if rx.match(template.utterance)]
+
+        # Only report the size of each template's matrix unless the resolved
+        # utterances are being reviewed
+        total = 0
+        full = 0
+        for template in templates:
+            count = template.count(types)
+            matrix = template.full(types)
+            total += count
+            full += matrix
+
+            print("Utterance:", template.utterance)
+            if OPTS.bypass and not OPTS.count and not OPTS.compile:
+                for row in self.expand(testname, [template], types):
+                    print("    \\---->", row.resolved)
+            elif count != matrix:
+                print("    \\----> %d of %d permutation(s)" % (count, matrix))
+            else:
+                print("    \\----> %d permutation(s)" % count)
+
+        print()
+        print("Total permutations:", total)
+        self.matrix += full
+        if OPTS.cover:
+            print("Covering %d-wise: %d of %d permutations (%.1f%% fewer)" %
+                  (OPTS.cover, total, full, 100.0 * (full - total) / full if full else 0.0))
+
+        if OPTS.compile:
+            if OPTS.filter:
+                print("Not compiling a plan for a filtered test")
+            else:
+                plan.write(self.sources, types, templates)
+                print("Compiled plan written:", plan.path)
+            return total
+
+        if OPTS.bypass or OPTS.count:
+            return total
+
+        cache = AudioCache(OPTS.inputdir, OPTS.cachesize)
+
+        if "setup" in test:
             print()
             print("=" * 80)
-            print("Resolving utterances")
+            print("Performing setup")
             print("=" * 80)
             print()
 
-            types = {}
-            for name in test.get("types", {}):
-                typename = "{%s}" % name
-                types[typename] = []
-                for val in test["types"][name]:
-                    types[typename] += self.get_values(val)
-
-            for val in test["utterances"]:
-                for utterance in self.get_values(val):
-                    typenames = VAR_RE.findall(utterance)
-
-                    iterables = []
-                    for typename in typenames:
-                        iterables.append(types[typename])
-
-                    for iterable in itertools.product(*iterables):
-                        t = {}
-                        ndx = 0
-                        for typename in typenames:
-                            t[typename] = iterable[ndx]
-                            ndx += 1
-
-                        # Substitute the slot names with values
-                        last = 0
-                        resolved = ""
-                        for match in VAR_RE.finditer(utterance):
-                            val = t[match.group(0)]
-                            resolved += utterance[last:match.start()] + val
-                            last = match.end()
-                        resolved += utterance[last:]
-
-                        print("Utterance:", utterance)
-                        print("    \---->", resolved)
-                        filepfx = resolved.replace(" ", "_").replace("'", "")
-                        tests.append([testname, utterance, resolved, filepfx, t])
-
-        if not OPTS.bypass:
-            if "setup" in test:
+            self.perform(cache, "SETUP_", test["setup"])
+
+        connections = ConnectionStats()
+        self.throttle = Throttle(OPTS.avstasks, OPTS.avsmax) if OPTS.adaptive else None
+
+        # Results from the skill are matched up with their utterances as they
+        # arrive, so checking them doesn't limit concurrency
+        results = None
+        if "unittest" in test or OPTS.keep:
+            results = ResultsQueue(OPTS.queueurl)
+            results.start()
+
+            # Utterances that can't be told apart by their slot values are
+            # sent one at a time
+            if not ResultsQueue.distinguishable(templates, types):
+                print("Utterances can't be told apart by their slot values...sending one at a time")
+                print()
+                results.serial = True
+
+        self.journal = None
+        if OPTS.incremental:
+            self.journal = Journal(OPTS.outputdir)
+
+        self.responses = None
+        if OPTS.fingerprint:
+            self.responses = ResponseIndex(OPTS.outputdir, testname)
+
+        if self.store is not None:
+            self.store.start_test(testname, total)
+
+        self.runner = None
+        if "unittest" in test:
+            self.runner = UnitRunner(test["unittest"].replace("{skilldir}", OPTS.skilldir).
+                                                      replace("{testsdir}", OPTS.testsdir),
+                                     self.store)
+
+        try:
+            if OPTS.splice:
                 print()
                 print("=" * 80)
-                print("Performing setup")
+                print("Generating phrases")
                 print("=" * 80)
                 print()
 
-                for action in test["setup"]:
-                    for val in self.get_values(action):
-                        filepfx = "SETUP_" + val.replace(" ", "_").replace("'", "")
-                        run_tts(filepfx, val)
-                        run_avs(filepfx)
+                self.generate_phrases(self.expand(testname, templates, types), cache)
 
-            print()
-            print("=" * 80)
-            print("Generating voice input files")
-            print("=" * 80)
-            print()
-
-            with ProcessPoolExecutor(max_workers=OPTS.ttstasks) as executor:
-                for testname, utterance, resolved, filepfx, _ in tests:
-                    name = os.path.join(OPTS.inputdir, filepfx + ".wav")
-                    if not os.path.exists(name) or OPTS.regen:
-                        print("Generating:", resolved)
-                        if OPTS.ttstasks == 1:
-                            run_tts(filepfx, resolved)
-                        else:
-                            executor.submit(run_tts, filepfx, resolved)
-                    else:
-                        print("Reusing:", resolved)
-                executor.shutdown(wait=True)
+            if OPTS.handoff == "memory":
+                print()
+                print("=" * 80)
+                print("Generating and processing voice input")
+                print("=" * 80)
+                print()
 
-            print()
-            print("=" * 80)
-            print("Processing voice input files")
-            print("=" * 80)
-            print()
+                self.handoff(test, self.expand(testname, templates, types), cache, connections, results)
 
-            with ProcessPoolExecutor(max_workers=OPTS.avstasks) as executor:
-                for testname, utterance, resolved, filepfx, types in tests:
-                    print("Recognizing:", resolved)
-                    if OPTS.avstasks > 1:
-                        executor.submit(run_avs, filepfx)
-                        continue
-                    run_avs(filepfx)
+                print()
+                cache.report()
+            elif OPTS.pipeline:
+                print()
+                print("=" * 80)
+                print("Generating and processing voice input files")
+                print("=" * 80)
+                print()
 
-                    # Continue to next utterance if we're not checking results
-                    if "unittest" not in test and not OPTS.keep:
-                        continue
+                self.pipeline(test, self.expand(testname, templates, types), cache, connections, results)
 
-                    # Get the results message
-                    resp = SQS.receive_message(QueueUrl=OPTS.queueurl, WaitTimeSeconds=10)
-                    if resp is None or "Messages" not in resp:
-                        print("Expected a results message...none received")
-                        continue
-                    msg = resp["Messages"][0]
+                print()
+                cache.report()
+            else:
+                print()
+                print("=" * 80)
+                print("Generating voice input files")
+                print("=" * 80)
+                print()
 
-                    # Delete it
-                    SQS.delete_message(QueueUrl=OPTS.queueurl, ReceiptHandle=msg["ReceiptHandle"])
+                self.generate(self.expand(testname, templates, types), cache)
 
-                    # Attempt to parse it
-                    try:
-                        er = json.loads(msg["Body"])
-                    except:
-                        print("Parsing results message failed")
-                        continue
+                print()
+                cache.report()
 
-                    # Make sure we have both the event and response dicts
-                    if "event" not in er or "response" not in er:
-                        print("Results message missing event/response dict")
-                        continue
+                print()
+                print("=" * 80)
+                print("Processing voice input files")
+                print("=" * 80)
+                print()
 
-                    # Remove the braces from the type names
-                    newtypes = {}
-                    for t in types:
-                        newtypes[t.strip("{}")] = types[t]
+                rows = self.expand(testname, templates, types)
+                if OPTS.engine == "async":
+                    self.recognize_async(test, rows, cache, connections, results)
+                else:
+                    self.recognize_rows(test, rows, cache, connections, results)
+
+            if results is not None:
+                results.finish()
+                self.check_results(test, results)
+
+                rows = results.resends()
+                if len(rows) > 0:
+                    print()
+                    print("=" * 80)
+                    print("Resending %d utterance(s) one at a time" % len(rows))
+                    print("=" * 80)
+                    print()
+
+                    if OPTS.handoff == "memory":
+                        self.handoff(test, rows, cache, connections, results)
+                    else:
+                        self.recognize_rows(test, rows, cache, connections, results)
+                    results.finish()
+                    self.check_results(test, results)
 
-                    # Create the unit test input
-                    data = \
-                    {
-                        "testname": testname,
-                        "utterance": utterance,
-                        "resolved": resolved,
-                        "types": newtypes,
-                        "message": er
-                    }
+            if self.responses is not None:
+                print()
+                print("=" * 80)
+                print("Fingerprinting responses")
+                print("=" * 80)
+                print()
 
-                    # Write it out if keeping results
-                    if OPTS.keep:
-                        with open(os.path.join(OPTS.outputdir, filepfx + ".txt"), "wt") as f:
-                            json.dump(data, f, indent=4)
+                self.responses.finish(self.scheduler.batch("tts", OPTS.ttstasks), self.tally)
+        finally:
+            if results is not None:
+                results.stop()
+            if self.runner is not None:
+                self.runner.close()
+            if self.journal is not None:
+                self.journal.close()
+            if self.store is not None:
+                self.store.finish_test()
+
+            snapshot = METRICS.take()
+            self.metrics.merge(snapshot)
+            metrics = Metrics()
+            metrics.merge(snapshot)
+            self.write_metrics(metrics, testname)
 
-                    # Done if we're not doing unit testing
-                    if "unittest" not in test:
-                        continue
+        print()
+        connections.report()
+        if self.throttle is not None:
+            self.throttle.report()
+            self.throttle = None
+        if self.journal is not None:
+            self.journal.report()
+            self.journal = None
+        if self.responses is not None:
+            self.responses.report()
+            self.responses = None
+        if results is not None:
+            results.report()
+        if self.runner is not None:
+            self.runner.report()
+            self.runner = None
+
+        if "cleanup" in test:
+            print()
+            print("=" * 80)
+            print("Performing cleanup")
+            print("=" * 80)
+            print()
 
-                    unittest = test["unittest"].replace("{skilldir}", OPTS.skilldir). \
-                                                replace("{testsdir}", OPTS.testsdir)
+            self.perform(cache, "CLEANUP_", test["cleanup"])
+            cache.save()
+
+        return total
+
+    def phrases(self, row, cache):
+        # Paths of the audio for each of the row's phrases when splicing
+        if not OPTS.splice:
+            return None
+        return [cache.path(cache.phrase_key(phrase))
+                for phrase in row.phrases("alexa ask %s " % OPTS.invocation)]
+
+    def generate_phrases(self, rows, cache):
+        # Each distinct phrase is only synthesized once, however many
+        # utterances it turns up in.  Utterances already in the cache don't
+        # need theirs.
+        generated = {}
+        reused = set()
+        utterances = 0
+        batch = self.scheduler.batch("tts", OPTS.ttstasks) if OPTS.ttstasks > 1 else None
+        for row in rows:
+            if os.path.exists(cache.path(cache.key(row.resolved))):
+                continue
+
+            utterances += 1
+            for phrase in row.phrases("alexa ask %s " % OPTS.invocation):
+                key = cache.phrase_key(phrase)
+                if key in generated or key in reused:
+                    continue
+                if cache.lookup(key) is not None:
+                    reused.add(key)
+                    continue
+
+                print("Generating phrase:", phrase)
+                generated[key] = phrase
+                if batch is None:
+                    self.tally(run_phrase(cache.path(key), phrase))
+                else:
+                    batch.submit(run_phrase, cache.path(key), phrase, callback=self.tallied)
+        if batch is not None:
+            batch.join()
 
-                    p = Popen(unittest, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-                    _, err = p.communicate(json.dumps(data))
+        for key, text in generated.items():
+            cache.add(key, text)
+        cache.save()
 
-                    leader = "Unittest:   "
-                    err = err.decode("UTF-8").replace("\r\n", "\n").replace("\r", "\n")
-                    for line in err.split("\n"):
-                        print("%s %s" % (leader, line))
-                        leader = " " * 12
+        print()
+        print("Phrases: %d generated, %d reused, for %d utterance(s)" %
+              (len(generated), len(reused), utterances))
+
+    def write_metrics(self, metrics, testname=None):
+        # Each test's metrics and then the run's are appended as JSON lines,
+        # or the run's replace the Prometheus text file
+        if not OPTS.metrics:
+            return
+
+        path = os.path.expanduser(OPTS.metrics)
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        if OPTS.metricsformat == "prometheus":
+            if testname is None:
+                tmp = "%s.%d.tmp" % (path, os.getpid())
+                with open(tmp, "wt") as f:
+                    f.write(metrics.prometheus())
+                os.replace(tmp, path)
+            return
+
+        with open(path, "at") as f:
+            for record in metrics.records(run=self.started, test=testname):
+                f.write(json.dumps(record) + "\n")
+
+    def generate(self, rows, cache):
+        generated = {}
+        batch = self.scheduler.batch("tts", OPTS.ttstasks) if OPTS.ttstasks > 1 else None
+        for row in rows:
+            key = cache.key(row.resolved)
+            if key in generated or cache.lookup(key) is not None:
+                print("Reusing:", row.resolved)
+                continue
+
+            print("Generating:", row.resolved)
+            generated[key] = row.resolved
+            if batch is None:
+                self.tally(run_tts(cache.path(key), row.resolved, self.phrases(row, cache)))
+            else:
+                batch.submit(run_tts, cache.path(key), row.resolved, self.phrases(row, cache),
+                             callback=self.tallied)
+        if batch is not None:
+            batch.join()
+
+        # Only the main process touches the index
+        for key, text in generated.items():
+            cache.add(key, text)
+        cache.save()
+
+    def pipeline(self, test, rows, cache, connections, results):
+        # Utterances go to AVS as soon as their voice file is ready, so the TTS
+        # and AVS pools are busy at the same time.  At most "depth" utterances
+        # can be waiting on TTS or waiting to be sent, which bounds the queue
+        # between the two stages.
+        depth = (OPTS.ttstasks + OPTS.avstasks) * 2
+        slots = threading.Semaphore(depth)
+        ready = queue.Queue()
+        lock = threading.Lock()
+        inflight = {}
+        generated = {}
+
+        threads = None
+        if OPTS.engine == "async":
+            threads = ThreadPoolExecutor(max_workers=self.avstasks())
+            avsbatch = Batch(threads, OPTS.avstasks * 2, self.throttle)
+        else:
+            avsbatch = self.scheduler.batch("avs", OPTS.avstasks, self.throttle)
+        ttsbatch = self.scheduler.batch("tts", depth)
+
+        def generated_cb(key):
+            def callback(future):
+                self.tallied(future)
+                with lock:
+                    waiting = inflight.pop(key)
+                for row in waiting:
+                    if future.exception() is None:
+                        ready.put((row, cache.path(key)))
+                    else:
+                        slots.release()
+            return callback
+
+        def dispatch():
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                row, path = item
+                print("Recognizing:", row.resolved)
+                expected = results.expect(row) if results is not None else None
+                avsbatch.submit(run_avs, path, row.filepfx,
+                                callback=self.recognized(connections, results, expected, row))
+                slots.release()
+            avsbatch.join()
+
+        dispatcher = threading.Thread(target=dispatch)
+        dispatcher.start()
+        try:
+            for row in rows:
+                self.check_results(test, results)
+
+                # No need to even generate it
+                if self.unchanged(row, results):
+                    continue
+
+                slots.acquire()
+                key = cache.key(row.resolved)
+                with lock:
+                    # Same text as one still being generated
+                    if key in inflight:
+                        inflight[key].append(row)
+                        continue
 
-                executor.shutdown(wait=True)
+                if key in generated or cache.lookup(key) is not None:
+                    print("Reusing:", row.resolved)
+                    ready.put((row, cache.path(key)))
+                    continue
+
+                print("Generating:", row.resolved)
+                generated[key] = row.resolved
+                with lock:
+                    inflight[key] = [row]
+                ttsbatch.submit(run_tts, cache.path(key), row.resolved, self.phrases(row, cache),
+                                callback=generated_cb(key))
+        finally:
+            ttsbatch.join()
+            ready.put(None)
+            dispatcher.join()
+            if threads is not None:
+                threads.shutdown(wait=True)
+
+        for key, text in generated.items():
+            cache.add(key, text)
+        cache.save()
+
+    def unchanged(self, row, results):
+        # Nothing that affects the answer has changed since AVS last answered
+        # this utterance, so reuse that answer (and its results message)
+        if self.journal is None or OPTS.refresh:
+            return False
+
+        entry = self.journal.lookup(Journal.key(row.resolved))
+        if entry is None or (results is not None and "message" not in entry):
+            return False
+
+        print("Unchanged:", row.resolved)
+        if self.responses is not None:
+            self.responses.add(row, entry["mp3"])
+        if self.store is not None:
+            self.store.record(row, status="unchanged",
+                              response=self.store.response(os.path.join(OPTS.outputdir, entry["mp3"])))
+        if results is not None:
+            results.replay(row, entry["message"])
+        return True
+
+    def answered(self, row, start=None):
+        if self.responses is not None:
+            self.responses.add(row, row.filepfx + ".mp3")
+        if self.journal is not None:
+            self.journal.record(Journal.key(row.resolved), mp3=row.filepfx + ".mp3")
+        if self.store is not None:
+            self.store.record(row, status="answered", sent=start,
+                              elapsed=time.time() - start if start is not None else None,
+                              response=self.store.response(os.path.join(OPTS.outputdir, row.filepfx + ".mp3")))
+
+    def unanswered(self, row):
+        if self.store is not None:
+            self.store.record(row, status="error")
+
+    def handoff(self, test, rows, cache, connections, results):
+        # Each worker synthesizes an utterance and sends the samples to AVS
+        # itself, so new audio never goes through a file on its way there.
+        # Cached audio is still sent from its file.
+        generated = {}
+        batch = self.scheduler.batch("avs", max(OPTS.ttstasks, OPTS.avstasks), self.throttle)
+        for row in rows:
+            self.check_results(test, results)
+            if self.unchanged(row, results):
+                continue
+
+            key = cache.key(row.resolved)
+            path = cache.path(key)
+            expected = results.expect(row) if results is not None else None
+            callback = self.recognized(connections, results, expected, row)
+
+            if (key not in generated and cache.lookup(key) is not None) or \
+               (key in generated and os.path.exists(path)):
+                print("Reusing:", row.resolved)
+                batch.submit(run_avs, path, row.filepfx, callback=callback)
+                continue
+
+            print("Generating:", row.resolved)
+
+            # Only write it once, even if it comes up again before the
+            # first write lands
+            persist = OPTS.persist and key not in generated
+            generated[key] = row.resolved
+            batch.submit(run_handoff, path if persist else None, row.resolved, row.filepfx,
+                         self.phrases(row, cache), callback=callback)
+        batch.join()
+
+        # Each job waited for its own write
+        for key, text in generated.items():
+            cache.add(key, text)
+        cache.save()
+
+    def recognize_rows(self, test, rows, cache, connections, results):
+        batch = None
+        if OPTS.avstasks > 1 or self.throttle is not None:
+            batch = self.scheduler.batch("avs", OPTS.avstasks, self.throttle)
+        for row in rows:
+            if self.unchanged(row, results):
+                self.check_results(test, results)
+                continue
+
+            print("Recognizing:", row.resolved)
+            path = cache.path(cache.key(row.resolved))
+            expected = results.expect(row) if results is not None else None
+            if batch is not None:
+                batch.submit(run_avs, path, row.filepfx,
+                             callback=self.recognized(connections, results, expected, row))
+            else:
+                start = time.time()
+                try:
+                    self.tally(run_avs(path, row.filepfx), connections)
+                    self.answered(row, start)
+                except Exception:
+                    self.unanswered(row)
+                    raise
+                finally:
+                    if results is not None:
+                        results.done(expected)
+
+            self.check_results(test, results)
+
+        if batch is not None:
+            batch.join()
+
+    def avstasks(self):
+        # The most AVS requests that may be under way at once
+        return self.throttle.ceiling if self.throttle is not None else OPTS.avstasks
+
+    def tally(self, stats, connections=None):
+        # Add up what a job reported about its work
+        if connections is not None:
+            connections.add(stats)
+        self.audio.add(stats)
+        METRICS.add(stats)
+        if self.throttle is not None:
+            self.throttle.add(stats)
+
+    def tallied(self, future, connections=None):
+        if future.exception() is None:
+            self.tally(future.result(), connections)
+
+    def recognized(self, connections, results, expected, row):
+        start = time.time()
+        def callback(future):
+            self.tallied(future, connections)
+            if future.exception() is None:
+                self.answered(row, start)
+            else:
+                self.unanswered(row)
+                if self.throttle is not None:
+                    self.throttle.fail()
+            if results is not None:
+                results.done(expected)
+        return callback
+
+    def check_results(self, test, results):
+        if results is None:
+            return
+
+        for row, er in results.matched():
+            if er is None:
+                print("Expected a results message...none received:", row.resolved)
+                if self.store is not None:
+                    self.store.record(row, status="nomessage")
+                continue
+
+            if self.journal is not None:
+                self.journal.record(Journal.key(row.resolved), message=er)
+            if self.store is not None:
+                self.store.record(row, message=er)
+
+            # Remove the braces from the type names
+            newtypes = {}
+            for t, v in row.types.items():
+                newtypes[t.strip("{}")] = v
+
+            # Create the unit test input
+            data = \
+            {
+                "testname": row.testname,
+                "utterance": row.utterance,
+                "resolved": row.resolved,
+                "types": newtypes,
+                "message": er
+            }
 
-            if "cleanup" in test:
+            # Write it out if keeping results
+            if OPTS.keep:
+                with open(os.path.join(OPTS.outputdir, row.filepfx + ".txt"), "wt") as f:
+                    json.dump(data, f, indent=4)
+
+            # Hand it to the unit test runner if we're doing unit testing
+            if self.runner is not None:
+                self.runner.submit(row, data)
+
+        if self.runner is not None:
+            self.runner.collect()
+
+    def recognize_async(self, test, rows, cache, connections, results):
+        # Everything runs on one event loop.  The HTTP calls themselves are
+        # blocking, so they're handed to a thread pool sized to the number of
+        # concurrent requests, with file I/O kept on its own small pool.
+        loop = asyncio.new_event_loop()
+        avs = AVS(poolsize=max(OPTS.avspool, self.avstasks()))
+
+        def read(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        async def recognize(row, expected, net, disk):
+            start = time.time()
+            try:
+                path = cache.path(cache.key(row.resolved))
+                wav = await loop.run_in_executor(disk, read, path)
+                await loop.run_in_executor(net, save_avs, avs, io.BytesIO(wav), row.filepfx)
+                self.tally(worker_stats(avs), connections)
+                self.answered(row, start)
+            except Exception:
+                self.unanswered(row)
+                if self.throttle is not None:
+                    self.throttle.fail()
+                print("Caught exception recognizing:")
+                print(row.resolved)
                 print()
-                print("=" * 80)
-                print("Performing cleanup")
-                print("=" * 80)
+                traceback.print_exc()
                 print()
+            finally:
+                if results is not None:
+                    results.done(expected)
+
+        async def dispatch():
+            with ThreadPoolExecutor(max_workers=self.avstasks()) as net, \
+                 ThreadPoolExecutor(max_workers=2) as disk:
+                running = set()
+                for row in rows:
+                    if self.unchanged(row, results):
+                        self.check_results(test, results)
+                        continue
+
+                    # Wait for room under the limit, which may have changed
+                    limit = self.throttle.window() if self.throttle is not None else OPTS.avstasks
+                    while len(running) >= limit:
+                        _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                        limit = self.throttle.window() if self.throttle is not None else OPTS.avstasks
+
+                    # Waiting for results messages mustn't hold up the loop
+                    while results is not None and not results.settled():
+                        await asyncio.sleep(0.1)
 
-                for action in test["setup"]:
-                    for val in self.get_values(action):
-                        filepfx = "CLEANUP_" + val.replace(" ", "_").replace("'", "")
-                        run_tts(filepfx, val)
-                        run_avs(filepfx)
+                    self.check_results(test, results)
+                    print("Recognizing:", row.resolved)
+                    expected = results.expect(row) if results is not None else None
+                    running.add(loop.create_task(recognize(row, expected, net, disk)))
+                if running:
+                    await asyncio.wait(running)
 
-        # Restore options
-        OPTS = deepcopy(savedopts)
+        try:
+            loop.run_until_complete(dispatch())
+        finally:
+            loop.close()
+
+    def perform(self, cache, prefix, actions):
+        for action in actions:
+            for val in self.get_values(action):
+                key = cache.key(val)
+                path = cache.lookup(key)
+                if path is None:
+                    path = cache.path(key)
+                    self.tally(run_tts(path, val))
+                    cache.add(key, val)
+                self.tally(run_avs(path, prefix + val.replace(" ", "_").replace("'", "")))
+
+    def resolve_types(self, test):
+        types = {}
+        for name in test.get("types", {}):
+            typename = "{%s}" % name
+            types[typename] = []
+            for val in test["types"][name]:
+                types[typename] += self.get_values(val)
+
+        return types
+
+    def compile_templates(self, test):
+        templates = []
+        for val in test["utterances"]:
+            for utterance in self.get_values(val):
+                templates.append(Template(utterance))
+
+        return templates
+
+    def expand(self, testname, templates, types):
+        # Rows are produced lazily so even huge matrices never live in memory.
+        # A compiled plan already has them.
+        if self.compiled is not None:
+            return self.compiled.rows(testname, templates)
+
+        return (Row(testname, template, values)
+                for template in templates
+                for values in template.combinations(types))
  
     def get_values(self, instr):
         instr = instr.replace("{skilldir}", OPTS.skilldir). \
                       replace("{testsdir}", OPTS.testsdir)
 
-        argv = shlex.split(instr)
-        args = self.parser.parse_args(argv)
+        args = self.parsed.get(instr)
+        if args is None:
+            args = self.parser.parse_args(shlex.split(instr))
+            self.parsed[instr] = args
         vals = args.func(self, args)
 
         if args.filter:
@@ -391,37 +3182,541 @@ class Tester(object):
         return vals
 
     def handle_exec(self, args):
-        vals = []
-        lines = check_output(args.cmd, shell=True).decode("UTF-8").replace("\r\n", "\n").replace("\r", "\n").split("\n")
-        for line in lines:
-            line = line.strip()
-            if not line.startswith("#") and len(line) > 0:
-                vals.append(line)
+        def run():
+            vals = []
+            lines = check_output(args.cmd, shell=True).decode("UTF-8").replace("\r\n", "\n").replace("\r", "\n").split("\n")
+            for line in lines:
+                line = line.strip()
+                if not line.startswith("#") and len(line) > 0:
+                    vals.append(line)
 
-        return vals
+            return vals
+
+        # Callers filter and sample the list, so hand out a copy
+        return list(self.values.get(ValueCache.exec_key(args.cmd), "exec", args.cmd, run))
 
     def handle_file(self, args):
-        vals = []
-        lines = args.path.readlines()
-        for line in lines:
-            line = line.strip()
-            if not line.startswith("#") and len(line) > 0:
-                if args.utterances:
-                    vals.append(line.partition(" ")[2].strip())
-                else:
-                    vals.append(line)
+        def read():
+            vals = []
+            with open(args.path, "rt") as f:
+                lines = f.readlines()
+            for line in lines:
+                line = line.strip()
+                if not line.startswith("#") and len(line) > 0:
+                    if args.utterances:
+                        vals.append(line.partition(" ")[2].strip())
+                    else:
+                        vals.append(line)
 
-        args.path.close()
+            return vals
 
-        return vals
+        # A compiled plan depends on the file staying the same
+        self.sources.add(os.path.abspath(args.path))
+
+        try:
+            key = ValueCache.file_key(args.path, args.utterances)
+        except OSError as e:
+            self.parser.error("can't open '%s': %s" % (args.path, e))
+        return list(self.values.get(key, "file", json.dumps([os.path.abspath(args.path), args.utterances]), read))
 
     def handle_text(self, args):
         return [args.text]
 
-class TTS(object):
+class EspeakLib(object):
+    # Drives libespeak directly so a single session can synthesize any number
+    # of utterances without starting a process for each one
+    def __init__(self, voice):
+        name = ctypes.util.find_library("espeak-ng") or ctypes.util.find_library("espeak")
+        if name is None:
+            raise OSError("libespeak not found")
+
+        self.lib = ctypes.CDLL(name)
+        self.lib.espeak_Initialize.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        self.lib.espeak_SetVoiceByName.argtypes = [ctypes.c_char_p]
+        self.lib.espeak_Synth.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint,
+                                          ctypes.c_int, ctypes.c_uint, ctypes.c_uint,
+                                          ctypes.POINTER(ctypes.c_uint), ctypes.c_void_p]
+
+        # AUDIO_OUTPUT_SYNCHRONOUS returns the audio via the callback
+        self.rate = self.lib.espeak_Initialize(2, 0, None, 0)
+        if self.rate <= 0:
+            raise OSError("libespeak initialization failed")
+
+        self.chunks = []
+        def collect(wav, numsamples, events):
+            if wav and numsamples > 0:
+                self.chunks.append(ctypes.string_at(wav, numsamples * 2))
+            return 0
+
+        # Keep a reference so the callback doesn't get collected
+        self.callback = ctypes.CFUNCTYPE(ctypes.c_int,
+                                         ctypes.POINTER(ctypes.c_short),
+                                         ctypes.c_int,
+                                         ctypes.c_void_p)(collect)
+        self.lib.espeak_SetSynthCallback(self.callback)
+
+        if self.lib.espeak_SetVoiceByName(voice.encode("UTF-8")) != 0:
+            raise OSError("espeak voice not found: %s" % voice)
+
+    def synth(self, text):
+        self.chunks = []
+        data = text.encode("UTF-8") + b"\0"
+
+        # POS_CHARACTER positions and espeakCHARS_UTF8 text
+        self.lib.espeak_Synth(data, len(data), 0, 1, 0, 1, None, None)
+        self.lib.espeak_Synchronize()
+
+        raw = np.frombuffer(b"".join(self.chunks), np.int16)
+        return raw.astype(np.float32) / 32768.0, self.rate
+
+    def close(self):
+        self.lib.espeak_Terminate()
+
+class MultipartReader(object):
+    # Splits a multipart response into its parts as it streams in.  Parts
+    # with a content type listed in sinks are written to that file in chunks
+    # while everything else is collected in memory, so big parts never have
+    # to fit in memory.
+    CHUNK = 16384
+
+    def __init__(self, ctype, sinks):
+        params = dict(param.strip().split("=", 1) for param in ctype.split(";")[1:] if "=" in param)
+        boundary = params.get("boundary", "").strip('"')
+        if not boundary:
+            raise ValueError("No multipart boundary in: %s" % ctype)
+
+        self.delim = b"\r\n--" + boundary.encode("ascii")
+        self.sinks = sinks
+        self.written = {}
+        self.parts = []
+        self.headers = None
+        self.body = None
+
+    @staticmethod
+    def ctype(headers):
+        return headers.get("content-type", "").split(";")[0].strip().lower()
+
+    def parse(self, chunks):
+        # Pretend the first boundary follows a line break like the others do
+        buf = bytearray(b"\r\n")
+        state = "preamble"
+        keep = len(self.delim) - 1
+        for chunk in chunks:
+            buf += chunk
+            while state != "done":
+                if state in ("preamble", "body"):
+                    ndx = buf.find(self.delim)
+                    if ndx < 0:
+                        # Hold back just enough to spot a delimiter split across chunks
+                        if len(buf) > keep:
+                            if state == "body":
+                                self.emit(buf[:len(buf) - keep])
+                            del buf[:len(buf) - keep]
+                        break
+
+                    if state == "body":
+                        self.emit(buf[:ndx])
+                        self.finish()
+                    del buf[:ndx + len(self.delim)]
+                    state = "delimiter"
+                elif state == "delimiter":
+                    if len(buf) < 2:
+                        break
+                    state = "done" if buf[:2] == b"--" else "headers"
+                elif state == "headers":
+                    ndx = buf.find(b"\r\n\r\n")
+                    if ndx < 0:
+                        break
+
+                    # Skip the rest of the boundary line
+                    self.start(bytes(buf[:ndx]).decode("latin-1").split("\r\n")[1:])
+                    del buf[:ndx + 4]
+                    state = "body"
+
+        if state != "done":
+            raise ValueError("Multipart response ended early")
+
+        return self.parts
+
+    def start(self, lines):
+        self.headers = {}
+        for line in lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                self.headers[name.strip().lower()] = value.strip()
+        self.body = bytearray()
+
+    def emit(self, data):
+        ctype = self.ctype(self.headers)
+        if ctype in self.sinks:
+            self.sinks[ctype].write(data)
+            self.written[ctype] = self.written.get(ctype, 0) + len(data)
+        else:
+            self.body += data
+
+    def finish(self):
+        # Parts that went to a sink have no data of their own
+        ctype = self.ctype(self.headers)
+        self.parts.append((self.headers, None if ctype in self.sinks else bytes(self.body)))
+
+class Resampler(object):
+    # Converts synthesizer output to the 16kHz that AVS wants.  Converters are
+    # created once per quality and reused for every clip a process handles.
+    converters = {}
+
+    def __init__(self, quality):
+        self.quality = quality
+        if quality not in Resampler.converters:
+            Resampler.converters[quality] = samplerate.Resampler(quality, channels=1)
+        self.converter = Resampler.converters[quality]
+
+    @timed("resample")
+    def resample(self, raw, rate):
+        if rate == 16000:
+            return raw
+
+        self.converter.reset()
+        return self.converter.process(raw, 16000.0 / rate, end_of_input=True)
+
+class Conditioner(object):
+    # Trims the silence synthesizers leave around speech and evens out the
+    # level of the voice input before it goes to AVS.  Clips are joined end
+    # to end so their frame energies, peaks and levels each come from a
+    # single numpy pass, which lets the phrases of a spliced utterance be
+    # trimmed together.  Each process keeps count of what it has done until
+    # the counts are collected.
+    FRAME = 160
+    totals = [0, 0, 0]
+
     def __init__(self):
+        self.threshold = OPTS.trimdb
+        self.pad = int(OPTS.trimpad * 16)
+        self.normalize = OPTS.normalize
+        self.level = 10.0 ** (OPTS.level / 20.0)
+
+    @staticmethod
+    def enabled():
+        return bool(OPTS.trim or OPTS.normalize)
+
+    @staticmethod
+    def signature():
+        # Everything about conditioning that affects the audio sent
+        signature = []
+        if OPTS.trim:
+            signature += ["trim", OPTS.trimdb, OPTS.trimpad]
+        if OPTS.normalize:
+            signature += ["normalize", OPTS.normalize, OPTS.level]
+        return signature
+
+    @staticmethod
+    def stats():
+        stats = tuple(Conditioner.totals)
+        Conditioner.totals = [0, 0, 0]
+        return stats
+
+    @staticmethod
+    def join(clips):
+        lengths = np.array([len(clip) for clip in clips], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        joined = np.concatenate(clips) if clips else np.zeros(0, dtype=np.float32)
+        return joined.astype(np.float32, copy=False), lengths, offsets
+
+    def bounds_many(self, clips):
+        # The first and last sample of each clip's speech: the span of its
+        # frames louder than the threshold, plus the padding.  Clips without
+        # any are left alone.
+        joined, lengths, offsets = Conditioner.join(clips)
+        frames = -(-lengths // Conditioner.FRAME)
+        firsts = np.concatenate(([0], np.cumsum(frames)))
+        owners = np.repeat(np.arange(len(clips)), frames)
+        framestarts = offsets[owners] + (np.arange(firsts[-1]) - firsts[owners]) * Conditioner.FRAME
+
+        # A clip's last frame may be short, so average over each frame's size
+        loud = np.zeros(0, dtype=np.int64)
+        if len(framestarts):
+            energy = np.add.reduceat(np.square(joined), framestarts)
+            energy /= np.diff(np.concatenate((framestarts, [len(joined)])))
+            loud = np.flatnonzero(10.0 * np.log10(energy + 1e-12) > self.threshold)
+        owners = owners[loud]
+        starts = [0] * len(clips)
+        ends = [len(clip) for clip in clips]
+        if len(loud):
+            clipnums, first = np.unique(owners, return_index=True)
+            _, last = np.unique(owners[::-1], return_index=True)
+            last = len(loud) - 1 - last
+            for n, lo, hi in zip(clipnums, loud[first], loud[last]):
+                starts[n] = max(int(lo - firsts[n]) * Conditioner.FRAME - self.pad, 0)
+                ends[n] = min(int(hi - firsts[n] + 1) * Conditioner.FRAME + self.pad, len(clips[n]))
+        return list(zip(starts, ends))
+
+    def trim_many(self, clips):
+        return [clip[start:end] for clip, (start, end) in zip(clips, self.bounds_many(clips))]
+
+    def gains(self, joined, lengths, offsets):
+        # Scale each clip to the level asked for, but never so far that it
+        # clips
+        nonempty = lengths > 0
+        starts = offsets[:-1][nonempty]
+        peaks = np.zeros(len(lengths), dtype=np.float64)
+        power = np.zeros(len(lengths), dtype=np.float64)
+        if len(starts):
+            peaks[nonempty] = np.maximum(np.maximum.reduceat(joined, starts), -np.minimum.reduceat(joined, starts))
+            if self.normalize == "rms":
+                power[nonempty] = np.add.reduceat(np.square(joined), starts, dtype=np.float64) / lengths[nonempty]
+
+        limit = np.where(peaks > 0, 32767.0 / 32768.0 / np.maximum(peaks, 1e-12), 1.0)
+        if self.normalize == "peak":
+            gains = np.where(peaks > 0, self.level / np.maximum(peaks, 1e-12), 1.0)
+        else:
+            rms = np.sqrt(power)
+            gains = np.where(rms > 0, self.level / np.maximum(rms, 1e-12), 1.0)
+        return np.minimum(gains, limit).astype(np.float32)
+
+    def process(self, raw, trimmed=0):
+        # Silence already trimmed from the phrases raw was spliced from still
+        # counts as synthesized
+        pcm = self.process_many([raw])[0]
+        Conditioner.totals[1] += trimmed
+        return pcm
+
+    @timed("condition")
+    def process_many(self, clips):
+        # Float clips in, 16-bit clips ready to send out
+        before = sum(len(clip) for clip in clips)
+        if OPTS.trim:
+            clips = self.trim_many(clips)
+
+        joined, lengths, offsets = Conditioner.join(clips)
+        if self.normalize:
+            joined *= np.repeat(self.gains(joined, lengths, offsets), lengths)
+
+        Conditioner.totals[0] += len(clips)
+        Conditioner.totals[1] += before
+        Conditioner.totals[2] += len(joined)
+        return np.split(quantize(joined), offsets[1:-1])
+
+class Fingerprint(object):
+    # A compact spectral fingerprint of a response: the log energy in BANDS
+    # log spaced bands over STEPS equal slices of the audio, less each band's
+    # average so the level and tone of the voice don't count.  Normalized, so
+    # the dot product of two is their similarity, 1.0 for the same audio.
+    BANDS = 32
+    STEPS = 32
+    matrices = {}
+
+    @staticmethod
+    def bands(size, rate):
+        # Which band each bin of the spectrum adds to
+        key = (size, rate)
+        if key not in Fingerprint.matrices:
+            freqs = np.fft.rfftfreq(size, 1.0 / rate)
+            edges = np.geomspace(100.0, min(8000.0, rate / 2.0), Fingerprint.BANDS + 1)
+            which = np.searchsorted(edges, freqs, side="right") - 1
+            inside = np.flatnonzero((which >= 0) & (which < Fingerprint.BANDS))
+            matrix = np.zeros((len(freqs), Fingerprint.BANDS), dtype=np.float32)
+            matrix[inside, which[inside]] = 1.0
+            Fingerprint.matrices[key] = matrix
+        return Fingerprint.matrices[key]
+
+    @staticmethod
+    @timed("fingerprint")
+    def compute(data):
+        # The duration and fingerprint of encoded audio, or None if it can't
+        # be decoded
+        try:
+            clip, rate = soundfile.read(io.BytesIO(data), dtype="float32", always_2d=True)
+        except Exception:
+            return None
+        clip = clip.mean(axis=1)
+
+        # Frames of about 32ms, overlapping by half
+        size = 1 << int(math.ceil(math.log2(rate * 0.032)))
+        if len(clip) < size:
+            clip = np.pad(clip, (0, size - len(clip)))
+        frames = np.lib.stride_tricks.sliding_window_view(clip, size)[::size // 2]
+        spectrum = np.square(np.abs(np.fft.rfft(frames * np.hanning(size).astype(np.float32), axis=1)))
+        energy = np.log10(spectrum @ Fingerprint.bands(size, rate) + 1e-10)
+
+        # Average the frames in each slice
+        starts = (np.arange(Fingerprint.STEPS) * len(energy)) // Fingerprint.STEPS
+        counts = np.diff(np.concatenate((starts, [len(energy)])))
+        steps = np.add.reduceat(energy, starts, axis=0) / np.maximum(counts, 1)[:, None]
+        steps -= steps.mean(axis=0)
+        norm = np.linalg.norm(steps)
+        if norm > 0:
+            steps /= norm
+        return len(clip) / float(rate), steps.ravel().astype(np.float16)
+
+# What each kind of worker imports to do its work
+STAGE_MODULES = \
+[
+    ("tts", ["numpy", "samplerate", "soundfile"]),
+    ("avs", ["requests"]),
+    ("login", ["bs4", "requests"]),
+    ("sqs", ["boto3"]),
+    ("unittest", []),
+    ("everything", ["asyncio", "boto3", "bs4", "numpy", "pstats", "requests", "samplerate", "soundfile"])
+]
+
+def rss():
+    # Resident memory of this process in MB, or its peak where that's all
+    # there is
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576.0
+    except (OSError, ValueError, AttributeError):
         pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1048576.0 if PLAT == "darwin" else 1024.0)
+
+def bench_worker(names):
+    before = rss()
+    start = time.perf_counter()
+    for name in names:
+        # Touching the module is what really imports it
+        getattr(importlib.import_module(name), "__name__")
+    return before, rss(), (time.perf_counter() - start) * 1000
+
+def bench_startup(runs=5):
+    # Every timing is from a fresh interpreter, so nothing is imported yet
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([here] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+
+    def timed_code(setup, code):
+        script = "%s\nimport time\nstart = time.perf_counter()\n%s\nprint((time.perf_counter() - start) * 1000)" % (setup, code)
+        return float(check_output([sys.executable, "-c", script], env=env).decode("UTF-8").split()[-1])
+
+    def timed_command(args):
+        start = time.perf_counter()
+        check_output([sys.executable, os.path.join(here, "skilltest.py")] + args, env=env)
+        return (time.perf_counter() - start) * 1000
+
+    tmp = tempfile.mkdtemp(prefix="skilltest")
+    tests = \
+    [
+        ("import skilltest", lambda: timed_code("", "import skilltest")),
+        ("skilltest --writeconfig", lambda: timed_command(["--writeconfig", os.path.join(tmp, "cfg")])),
+    ]
+    for name in sorted(set(name for _, names in STAGE_MODULES for name in names)):
+        tests.append(("first use of " + name,
+                      lambda name=name: timed_code("import importlib, skilltest",
+                                                   "getattr(importlib.import_module(%r), '__name__')" % name)))
+
+    print("Startup: median of %d run(s)" % runs)
+    print()
+    print("%-40s %10s" % ("", "ms"))
+    print("-" * 51)
+    try:
+        for what, func in tests:
+            print("%-40s %10.1f" % (what, sorted(func() for _ in range(runs))[runs // 2]))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # One fresh worker per stage, started the way the pools start them
+    print()
+    print("Worker memory: %s start method, %s MB for this process" %
+          (multiprocessing.get_start_method(), "%.1f" % rss() if rss() is not None else "-"))
+    print()
+    print("%-12s %-30s %9s %9s %9s" % ("stage", "imports", "start MB", "ready MB", "load ms"))
+    print("-" * 73)
+    for stage, names in STAGE_MODULES:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            before, after, ms = pool.submit(bench_worker, names).result()
+        print("%-12s %-30s %9s %9s %9.1f" %
+              (stage, ", ".join(names) if len(names) < 4 else "all", 
+               "%.1f" % before if before is not None else "-",
+               "%.1f" % after if after is not None else "-", ms))
+
+def bench_resample(clips=200, rate=22050):
+    # Speech-like test clips: noise under a syllable rate envelope, 0.5 to 3 seconds long
+    rs = np.random.RandomState(0)
+    data = []
+    for length in rs.randint(rate // 2, rate * 3, clips):
+        t = np.arange(length) / float(rate)
+        data.append(rs.randn(length) * 0.3 * np.abs(np.sin(2 * np.pi * 4 * t)))
+    seconds = sum(len(clip) for clip in data) / float(rate)
+
+    print("Resampling %d clips (%.1f seconds of audio) from %dHz to 16000Hz" % (clips, seconds, rate))
+    print()
+    print("%-16s %-10s %10s %12s" % ("Quality", "Method", "Clips/sec", "x Realtime"))
+    print("-" * 51)
+
+    for quality in ["sinc_best", "sinc_medium", "sinc_fastest", "linear", "zero_order_hold"]:
+        resampler = Resampler(quality)
+        methods = \
+        [
+            ("oneshot", lambda: [samplerate.resample(clip, 16000.0 / rate, quality) for clip in data]),
+            ("reused", lambda: [resampler.resample(clip, rate) for clip in data])
+        ]
+        for method, func in methods:
+            start = time.time()
+            func()
+            elapsed = max(time.time() - start, 1e-9)
+            print("%-16s %-10s %10.1f %12.1f" % (quality, method, clips / elapsed, seconds / elapsed))
+
+# PowerShell script that keeps a SpeechSynthesizer around and converts one
+# base64 encoded utterance per input line into one line of base64 encoded
+# 16kHz, 16-bit, mono PCM
+SAPI_SERVER = """
+    add-Type -AssemblyName System.Speech;
+    add-Type -AssemblyName System.IO;
+    $fmt = New-Object System.Speech.AudioFormat.SpeechAudioFormatInfo(16000, [System.Speech.AudioFormat.AudioBitsPerSample]::Sixteen, [System.Speech.AudioFormat.AudioChannel]::Mono);
+    $synth = New-Object System.Speech.Synthesis.SpeechSynthesizer;
+    if ('%s') { $synth.SelectVoice('%s'); }
+    while (($line = [Console]::In.ReadLine()) -ne $null) {
+        $text = [System.Text.Encoding]::UTF8.GetString([System.Convert]::FromBase64String($line));
+        $wav = New-Object System.IO.MemoryStream;
+        $synth.SetOutputToAudioStream($wav, $fmt);
+        $synth.Speak($text);
+        $synth.SetOutputToNull();
+        [Console]::Out.WriteLine([System.Convert]::ToBase64String($wav.ToArray()));
+        [Console]::Out.Flush();
+        $wav.Dispose();
+    }
+    $synth.Dispose();
+    exit;
+    """
+
+class TTS(object):
+    def __init__(self, persistent=False):
+        # Persistent instances keep their synthesizer session open between
+        # utterances instead of starting a new one each time
+        self.persistent = persistent
+        self.pid = os.getpid()
+        self.settings = (OPTS.synth, self.voice())
+        self.session = None
+
+    def close(self):
+        if self.session is None:
+            return
+
+        if isinstance(self.session, Popen):
+            self.session.stdin.close()
+            self.session.wait()
+        elif isinstance(self.session, EspeakLib):
+            self.session.close()
+        self.session = None
+
+    @staticmethod
+    def signature():
+        # Everything about the synthesizer that affects the audio it produces
+        signature = [OPTS.synth, TTS.voice()]
+        if OPTS.synth == "espeak":
+            signature.append(OPTS.resample)
+        return signature
+
+    @staticmethod
+    def voice():
+        # The espeak default voice doesn't work well with AVS
+        if OPTS.synth == "espeak":
+            return OPTS.voice or "en+m2"
+        return OPTS.voice
 
+    @timed("tts")
     def convert(self, text):
         if OPTS.synth == "espeak":
             raw = self.espeakTTS(text)
@@ -431,18 +3726,41 @@ class TTS(object):
             raw = self.sapiTTS(text)
         return raw
 
+    def pcm(self, text, condition=True):
+        # 16-bit samples, ready to be sent as audio/L16
+        raw = self.convert(text)
+        if condition and Conditioner.enabled():
+            if raw.dtype == np.int16:
+                raw = raw.astype(np.float32) / 32768.0
+            return Conditioner().process(raw)
+        if raw.dtype != np.int16:
+            return quantize(raw)
+        return np.ascontiguousarray(raw)
+
     def espeakTTS(self, text):
-        p = Popen("espeak -v en+m2 --stdin --stdout", shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        if self.persistent and self.session is None:
+            try:
+                self.session = EspeakLib(self.voice())
+            except OSError as e:
+                print("Persistent espeak unavailable (%s)...using espeak command" % e)
+                self.persistent = False
+
+        if self.persistent:
+            raw, rate = self.session.synth(text)
+        else:
+            p = Popen(["espeak", "-v", self.voice(), "--stdin", "--stdout"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
-        out = p.communicate(text.encode("UTF-8"))[0]
-        raw, rate = soundfile.read(io.BytesIO(out))
-        return samplerate.resample(raw, 16000.0 / rate, "sinc_best")
+            out = p.communicate(text.encode("UTF-8"))[0]
+            raw, rate = soundfile.read(io.BytesIO(out), dtype="float32")
+
+        return Resampler(OPTS.resample).resample(raw, rate)
 
     def osxTTS(self, text):
-        p = Popen("tmp=$(mktemp) ; say --file-format=WAVE --data-format=LEI16@16000 -o ${tmp} && cat ${tmp} ; rm ${tmp}", shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        voice = "-v '%s'" % self.voice().replace("'", "'\\''") if self.voice() else ""
+        p = Popen("tmp=$(mktemp) ; say %s --file-format=WAVE --data-format=LEI16@16000 -o ${tmp} && cat ${tmp} ; rm ${tmp}" % voice, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
-        out = p.communicate(bytes(text))[0]
-        return soundfile.read(io.BytesIO(out))[0]
+        out = p.communicate(text.encode("UTF-8"))[0]
+        return soundfile.read(io.BytesIO(out), dtype="int16")[0]
 
     def sapiTTS(self, text):
         if PLAT == "win32":
@@ -458,14 +3776,23 @@ class TTS(object):
             strm = CreateObject("sapi.SpMemoryStream")
             strm.Format = afmt
 
-            # Create the voice (uses the default system voice)
-            spkr = CreateObject("sapi.SpVoice")
-            spkr.AllowOutputFormatChangesOnNextSet = False
+            # Create the voice (uses the default system voice unless one was given)
+            spkr = self.session
+            if spkr is None:
+                spkr = CreateObject("sapi.SpVoice")
+                if self.voice():
+                    spkr.Voice = spkr.GetVoices("Name=%s" % self.voice()).Item(0)
+                spkr.AllowOutputFormatChangesOnNextSet = False
+                if self.persistent:
+                    self.session = spkr
             spkr.AudioOutputStream = strm
             spkr.Speak(text)
 
             return np.fromstring(bytes(strm.GetData()), np.int16);
 
+        if self.persistent:
+            return self.sapiServerTTS(text)
+
         # Get powershell up and running
         p = Popen("powershell.exe -NonInteractive -File -", shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=False, cwd="/mnt/c")
 
@@ -476,25 +3803,112 @@ class TTS(object):
               $fmt = New-Object System.Speech.AudioFormat.SpeechAudioFormatInfo(16000, [System.Speech.AudioFormat.AudioBitsPerSample]::Sixteen, [System.Speech.AudioFormat.AudioChannel]::Mono);
               $wav = New-Object System.IO.MemoryStream;
               $synth = New-Object System.Speech.Synthesis.SpeechSynthesizer;
+              if ('%s') { $synth.SelectVoice('%s'); }
               $synth.SetOutputToAudioStream($wav, $fmt);
               $synth.Speak('%s');
               [Console]::Error.Write([System.convert]::ToBase64String($wav.ToArray()));
               $synth.Dispose();
               $wav.Dispose();
               exit;
-              """ % text.replace("'", "''")
+              """ % (self.voice().replace("'", "''"),
+                     self.voice().replace("'", "''"),
+                     text.replace("'", "''"))
 
         # Send them and get the response from stderr
         out = p.communicate(cmd.encode("UTF-8"))[1]
         return np.fromstring(base64.b64decode(out.decode("UTF-8")), np.int16)
 
+    def sapiServerTTS(self, text):
+        if self.session is None:
+            # Script goes on the command line so stdin is free for utterances
+            voice = self.voice().replace("'", "''")
+            script = SAPI_SERVER % (voice, voice)
+            self.session = Popen(["powershell.exe", "-NonInteractive", "-NoProfile",
+                                  "-EncodedCommand", base64.b64encode(script.encode("UTF-16LE")).decode("ascii")],
+                                 stdin=PIPE, stdout=PIPE, cwd="/mnt/c")
+
+        self.session.stdin.write(base64.b64encode(text.encode("UTF-8")) + b"\n")
+        self.session.stdin.flush()
+
+        line = self.session.stdout.readline()
+        if not line:
+            self.session = None
+            raise RuntimeError("SAPI server exited unexpectedly")
+
+        return np.frombuffer(base64.b64decode(line.strip()), np.int16)
+
 class AVS(object):
-    def __init__(self):
+    # Statuses worth trying again, and those that mean slow down
+    RETRY = (408, 429, 500, 502, 503, 504)
+    THROTTLED = (429, 503)
+
+    def __init__(self, poolsize=None):
+        # One long lived session is used for everything so connections are
+        # kept alive and reused across recognize and token requests
+        self.pid = os.getpid()
+        self.settings = (OPTS.avspool, OPTS.keepalive)
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=poolsize or OPTS.avspool,
+                                                     pool_maxsize=poolsize or OPTS.avspool,
+                                                     max_retries=0)
         self.sess = requests.Session()
-        self.sess.mount("https://", requests.adapters.HTTPAdapter(max_retries=0))
-
-    def recognize(self, wav):
-        self.auth()
+        self.sess.mount("https://", self.adapter)
+        self.sess.mount("http://", self.adapter)
+        if not OPTS.keepalive:
+            self.sess.headers["Connection"] = "close"
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            return self.collect()
+
+    def collect(self):
+        # Requests and new connections per host since the last call
+        stats = {}
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            counts = (pool.num_requests, pool.num_connections)
+            last = self.counts.get(key, (0, 0))
+            self.counts[key] = counts
+            host = stats.setdefault(pool.host, [0, 0])
+            host[0] += counts[0] - last[0]
+            host[1] += counts[1] - last[1]
+        return stats
+
+    @staticmethod
+    def delay(attempt, retryafter=None):
+        # Full jitter exponential backoff, unless the service said how long
+        # to wait, in which case a little jitter keeps the workers it told
+        # the same thing from all coming back at once
+        cap = min(OPTS.backoffmax, OPTS.backoff * 2 ** attempt)
+        if retryafter:
+            try:
+                wait = float(retryafter)
+            except ValueError:
+                try:
+                    wait = (parsedate_to_datetime(retryafter) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    wait = None
+            if wait is not None:
+                return min(OPTS.backoffmax, max(0.0, wait)) + random.uniform(0, OPTS.backoff)
+        return random.uniform(0, cap)
+
+    @timed("backoff")
+    def backoff(self, delay):
+        time.sleep(delay)
+
+    @timed("upload")
+    def recognize(self, wav, out):
+        # The audio is either an open file or a buffer of raw samples.  The
+        # response audio is written to out as it arrives and the JSON parts
+        # are returned, or None if the request failed.
+        def rewind():
+            if hasattr(wav, "seek"):
+                wav.seek(0)
+
+        access = get_tokens().access(self)
 
         # make a copy of the headers
         headers = deepcopy(HEADERS)
@@ -520,7 +3934,7 @@ class AVS(object):
             "messageBody": 
             {
                 "profile": "alexa-close-talk",
-                "locale": "en-us",
+                "locale": OPTS.locale,
                 "format": "audio/L16; rate=16000; channels=1"
             }
         }
@@ -545,45 +3959,79 @@ class AVS(object):
             )
         ]
 
-        headers["Authorization"] = "Bearer %s" % OPTS.access
-
-        # Call AVS
-        url = "https://access-alexa-na.amazon.com/v1/avs/speechrecognizer/recognize"
-        try:
-            r = requests.post(url, headers=headers, files=files)
-        except:
-            wav.seek(0)
-            r = requests.post(url, headers=headers, files=files)
-
-        # Possibly refresh token and retry
-        if r.status_code == 403:
-            headers["Authorization"] = "Bearer %s" % self.refresh()
-            r = requests.post(url, headers=headers, files=files)
-
-        # If the request fails, retry
-        if r.status_code != 200:
-            #print(r.status_code)
-            #for header in r.headers:
-            #    print("HEADER:", header, ":", r.headers[header])
-            #print(r.content)
-            wav.seek(0)
-            r = requests.post(url, headers=headers, files=files)
+        headers["Authorization"] = "Bearer %s" % access
 
-        try:
-            for part in MultipartDecoder.from_response(r).parts:
-                if part.headers[b"Content-Type"] == b"audio/mpeg":
-                    return part.content
-        except:
-            pass
+        if isinstance(wav, memoryview):
+            size = wav.nbytes
+        elif isinstance(wav, io.BytesIO):
+            size = wav.getbuffer().nbytes
+        else:
+            size = os.fstat(wav.fileno()).st_size
+
+        def received(chunks):
+            for chunk in chunks:
+                METRICS.count("bytes_received", len(chunk))
+                yield chunk
+
+        # Call AVS, backing off and trying again after errors and throttling
+        # until the request's retry budget runs out.  Responses are streamed,
+        # so failed ones are read in full to give their connection back to
+        # the pool.  Losing a response part way through counts as an error,
+        # and the next attempt writes the response audio over from the start.
+        url = OPTS.avsurl + "/v1/avs/speechrecognizer/recognize"
+        r = None
+        reader = None
+        delay = 0.0
+        refreshed = False
+        for attempt in range(OPTS.retries + 1):
+            if attempt > 0:
+                self.backoff(delay)
+                rewind()
+            METRICS.count("retries" if attempt else "requests")
+            METRICS.count("bytes_sent", size)
+            try:
+                r = self.sess.post(url, headers=headers, files=files, stream=True)
+                if r.status_code == 200:
+                    out.seek(0)
+                    out.truncate()
+                    reader = MultipartReader(r.headers.get("Content-Type", ""), {"audio/mpeg": out})
+                    parts = reader.parse(received(r.iter_content(MultipartReader.CHUNK)))
+                    break
+            except (requests.RequestException, ValueError):
+                if attempt == OPTS.retries:
+                    raise
+                reader = None
+                delay = self.delay(attempt)
+                continue
+            r.content
+
+            # Possibly refresh token and retry straight away, but only once
+            if r.status_code == 403 and not refreshed:
+                refreshed = True
+                delay = 0.0
+                headers["Authorization"] = "Bearer %s" % get_tokens().access(self, rejected=access)
+                continue
+
+            if r.status_code not in AVS.RETRY:
+                break
+            if r.status_code in AVS.THROTTLED:
+                METRICS.count("throttled")
+            delay = self.delay(attempt, r.headers.get("Retry-After"))
+
+        if reader is not None and reader.written.get("audio/mpeg"):
+            return [json.loads(data.decode("UTF-8")) for headers, data in parts
+                    if MultipartReader.ctype(headers) == "application/json"]
 
         # Request failed
         print(r.status_code)
         for header in r.headers:
             print(header, ":", r.headers[header])
-        print(r.content)
+        if not r._content_consumed:
+            print(r.content)
 
         return None
 
+    @timed("login")
     def auth(self):
         # Make a copy of the headers
         headers = deepcopy(HEADERS)
@@ -623,10 +4071,10 @@ class AVS(object):
         code = None
 
         # Refrieve the login page
-        r = self.sess.get("https://www.amazon.com/ap/oa", headers=headers, params=data)
+        r = self.sess.get(OPTS.loginurl + "/ap/oa", headers=headers, params=data)
 
         # Extract the form fields
-        form = BeautifulSoup(r.text, "html.parser").find("form", {"name": "acknowledgement-form"})
+        form = bs4.BeautifulSoup(r.text, "html.parser").find("form", {"name": "acknowledgement-form"})
         if form is not None:
             data = {}
             for field in form.find_all("input"):
@@ -645,7 +4093,7 @@ class AVS(object):
 
         if code is None:
             # Extract the form fields
-            form = BeautifulSoup(r.text, "html.parser").find("form", {"name": "signIn"})
+            form = bs4.BeautifulSoup(r.text, "html.parser").find("form", {"name": "signIn"})
             if form is not None:
                 data = {}
                 for field in form.find_all("input"):
@@ -665,7 +4113,7 @@ class AVS(object):
                 r, code = redirect_to(r)
                 
         if code is None:
-            form = BeautifulSoup(r.text, "html.parser").find("form", {"name": "consent-form"})
+            form = bs4.BeautifulSoup(r.text, "html.parser").find("form", {"name": "consent-form"})
             if form is not None:
                 data = {}
                 for field in form.find_all("input"):
@@ -692,32 +4140,368 @@ class AVS(object):
         }
 
         # Retreive the access code
-        r = self.sess.post("https://api.amazon.com/auth/o2/token", headers=headers, data=data)
-        data = r.json()
-        if "access_token" in data and "refresh_token" in data:
-            OPTS.access = data["access_token"]
-            OPTS.refresh = data["refresh_token"]
+        r = self.sess.post(OPTS.apiurl + "/auth/o2/token", headers=headers, data=data)
+        return self.tokens(r)
 
-    def refresh(self):
+    @timed("token")
+    def refresh(self, token):
         # make a copy of the headers
         headers = deepcopy(HEADERS)
 
         data = \
         {
             "grant_type": "refresh_token",
-            "refresh_token": OPTS.refresh,
+            "refresh_token": token,
             "client_id": OPTS.clientid,
             "client_secret": OPTS.secret
         }
 
         # Retrieve a new refresh token
-        r = self.sess.post("https://api.amazon.com/auth/o2/token", headers=headers, data=data)
-        data = r.json()
-        if "access_token" in data and "refresh_token" in data:
-            OPTS.access = data["access_token"]
-            OPTS.refresh = data["refresh_token"]
+        r = self.sess.post(OPTS.apiurl + "/auth/o2/token", headers=headers, data=data)
+        return self.tokens(r)
 
-        return OPTS.access
+    def tokens(self, r):
+        try:
+            data = r.json()
+        except ValueError:
+            return None
+
+        if "access_token" not in data or "refresh_token" not in data:
+            return None
+
+        return \
+        {
+            "ident": TokenCache.ident(),
+            "access": data["access_token"],
+            "refresh": data["refresh_token"],
+            "expires": time.time() + int(data.get("expires_in", 3600))
+        }
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # Stands in for the AVS login, token and recognize endpoints as well as
+    # an SQS queue (JSON protocol) so skilltest can be exercised locally
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b"", ctype="text/html; charset=UTF-8", headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/ap/oa":
+            # A sign in form much like the real one
+            query = parse_qs(url.query)
+            page = """<html><body>
+                      <form name="signIn" method="post" action="http://%s/ap/signin">
+                      <input type="hidden" name="redirect_uri" value="%s"/>
+                      <input type="hidden" name="client_id" value="%s"/>
+                      <input type="email" name="email" value=""/>
+                      <input type="password" name="password" value=""/>
+                      </form></body></html>""" % (self.headers["Host"],
+                                                  query.get("redirect_uri", [""])[0],
+                                                  query.get("client_id", [""])[0])
+            self.reply(200, page.encode("UTF-8"))
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/ap/signin":
+            form = parse_qs(self.body().decode("UTF-8"))
+            code = base64.urlsafe_b64encode(os.urandom(12)).decode("ascii")
+            self.reply(302, headers={"Location": "%s?code=%s" % (form["redirect_uri"][0], code)})
+        elif path == "/auth/o2/token":
+            self.body()
+            self.reply(200, json.dumps(self.server.issue()).encode("UTF-8"), "application/json")
+        elif path == "/v1/avs/speechrecognizer/recognize":
+            self.recognize()
+        elif "X-Amz-Target" in self.headers:
+            self.sqs(self.headers["X-Amz-Target"].split(".")[-1], json.loads(self.body().decode("UTF-8") or "{}"))
+        else:
+            self.reply(404)
+
+    def recognize(self):
+        body = self.body()
+        server = self.server
+        settings = server.settings
+        server.count("requests")
+
+        # Turn away requests beyond what the server can take at once
+        if not server.enter():
+            server.count("throttled")
+            headers = {"Retry-After": str(settings["retryafter"])} if settings["retryafter"] else {}
+            self.reply(429, b'{"error": "too many requests"}', "application/json", headers)
+            return
+        try:
+            self.answer(body)
+        finally:
+            server.leave()
+
+    def answer(self, body):
+        server = self.server
+        settings = server.settings
+
+        time.sleep(max(0.0, random.gauss(settings["latency"], settings["jitter"])))
+
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        if not server.valid(token) or random.random() < settings["forbidden"]:
+            server.count("forbidden")
+            self.reply(403, b'{"error": "invalid token"}', "application/json")
+            return
+
+        if random.random() < settings["errors"] or b'name="audio"' not in body:
+            server.count("errors")
+            self.reply(500, b'{"error": "internal error"}', "application/json")
+            return
+
+        # The skill would have written its results message by now
+        server.send(json.dumps({"event": {"request": {"type": "IntentRequest",
+                                                      "requestId": "fake.%d" % server.stats["requests"],
+                                                      "intent": {"name": "FakeIntent", "slots": {}}}},
+                                "response": {"response": {"outputSpeech": {"type": "SSML",
+                                                                           "ssml": "<speak>fake</speak>"}}}}))
+
+        boundary = "fake-boundary-%s" % base64.b16encode(os.urandom(8)).decode("ascii")
+        directive = json.dumps({"messageBody": {"directives": [{"namespace": "SpeechSynthesizer",
+                                                                "name": "speak",
+                                                                "payload": {"audioContent": "cid:fake"}}]}})
+        audio = server.audio()
+        parts = \
+        [
+            b"--" + boundary.encode("ascii"),
+            b"\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n",
+            directive.encode("UTF-8"),
+            b"\r\n--" + boundary.encode("ascii"),
+            b"\r\nContent-ID: <fake>\r\nContent-Type: audio/mpeg\r\n\r\n",
+            audio,
+            b"\r\n--" + boundary.encode("ascii") + b"--\r\n"
+        ]
+        server.count("responses")
+        self.reply(200, b"".join(parts), "multipart/related; boundary=%s; type=\"application/json\"" % boundary)
+
+    def sqs(self, action, req):
+        server = self.server
+        if action == "ReceiveMessage":
+            msgs = server.receive(int(req.get("MaxNumberOfMessages", 1)),
+                                  int(req.get("WaitTimeSeconds", 0)))
+            resp = {"Messages": msgs} if msgs else {}
+        elif action == "DeleteMessage":
+            resp = {}
+        elif action == "DeleteMessageBatch":
+            resp = {"Successful": [{"Id": entry["Id"]} for entry in req.get("Entries", [])], "Failed": []}
+        elif action == "SendMessage":
+            resp = server.send(req["MessageBody"])
+        else:
+            self.reply(400, json.dumps({"__type": "com.amazonaws.sqs#InvalidAction",
+                                        "message": "unsupported action %s" % action}).encode("UTF-8"),
+                       "application/x-amz-json-1.0")
+            return
+        self.reply(200, json.dumps(resp).encode("UTF-8"), "application/x-amz-json-1.0")
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        HTTPServer.__init__(self, address, FakeHandler)
+        self.settings = dict(CFG["fake"], **settings)
+        self.lock = threading.Condition()
+        self.tokens = {}
+        self.messages = []
+        self.stats = {"requests": 0, "responses": 0, "errors": 0, "forbidden": 0, "throttled": 0, "tokens": 0}
+        self.active = 0
+        self.canned = []
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def audio(self):
+        # Every response is different unless only a few distinct ones are
+        # handed out
+        if not self.settings["distinct"]:
+            return b"ID3" + os.urandom(max(0, self.settings["audiosize"] - 3))
+        with self.lock:
+            if not self.canned:
+                self.canned = [b"ID3" + os.urandom(max(0, self.settings["audiosize"] - 3))
+                               for _ in range(self.settings["distinct"])]
+        return random.choice(self.canned)
+
+    def enter(self):
+        with self.lock:
+            if self.settings["capacity"] and self.active >= self.settings["capacity"]:
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def issue(self):
+        with self.lock:
+            self.stats["tokens"] += 1
+            access = base64.b16encode(os.urandom(16)).decode("ascii")
+            self.tokens[access] = time.time() + self.settings["expires"]
+        return {"access_token": access,
+                "refresh_token": base64.b16encode(os.urandom(16)).decode("ascii"),
+                "token_type": "bearer",
+                "expires_in": self.settings["expires"]}
+
+    def valid(self, access):
+        with self.lock:
+            return self.tokens.get(access, 0) > time.time()
+
+    def send(self, body):
+        msg = {"MessageId": base64.b16encode(os.urandom(8)).decode("ascii"),
+               "ReceiptHandle": base64.b16encode(os.urandom(8)).decode("ascii"),
+               "MD5OfBody": hashlib.md5(body.encode("UTF-8")).hexdigest(),
+               "Body": body}
+        with self.lock:
+            self.messages.append(msg)
+            self.lock.notify_all()
+        return {"MessageId": msg["MessageId"], "MD5OfMessageBody": msg["MD5OfBody"]}
+
+    def receive(self, count, wait):
+        end = time.time() + wait
+        with self.lock:
+            while len(self.messages) == 0 and time.time() < end:
+                self.lock.wait(end - time.time())
+            msgs = self.messages[:count]
+            del self.messages[:count]
+        return msgs
+
+def start_fake(port=0):
+    server = FakeServer(("127.0.0.1", port), OPTS.fake)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def fake_server(port):
+    server = start_fake(port)
+    print("Fake AVS and SQS server listening on http://127.0.0.1:%d" % server.server_address[1])
+    print("Point avsurl, loginurl, apiurl and sqsendpoint at it and set queueurl to")
+    print("http://127.0.0.1:%d/queue/skilltest" % server.server_address[1])
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+def timed_avs(path, filepfx):
+    start = time.time()
+    avs = get_avs()
+    with open(path, "rb") as infile:
+        save_avs(avs, infile, filepfx)
+    return time.time() - start, worker_stats(avs)
+
+def load_test(levels):
+    global SQS
+
+    # Everything points at a local fake server
+    server = start_fake()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    OPTS.avsurl = OPTS.loginurl = OPTS.apiurl = OPTS.sqsendpoint = url
+    OPTS.redirect = url + "/return"
+    OPTS.queueurl = url + "/queue/skilltest"
+
+    # Don't let the fake tokens near the real ones
+    tmp = tempfile.mkdtemp(prefix="skilltest")
+    OPTS.outputdir = tmp
+    OPTS.tokencache = os.path.join(tmp, "tokens")
+
+    # The fake server doesn't check signatures
+    from botocore import UNSIGNED
+    from botocore.config import Config
+    SQS = boto3.client("sqs", endpoint_url=url, region_name="us-east-1",
+                       config=Config(signature_version=UNSIGNED))
+
+    # Two seconds of 16kHz audio
+    path = os.path.join(tmp, "loadtest.wav")
+    soundfile.write(path, np.random.RandomState(0).randn(32000) * 0.1, 16000, format="WAV")
+
+    requests = server.settings["requests"]
+    print("Load test: %d request(s) per level, %s engine, %.0fms +/- %.0fms latency" %
+          (requests, OPTS.engine, server.settings["latency"] * 1000, server.settings["jitter"] * 1000))
+    print()
+    print("%8s %10s %10s %9s %9s %9s %9s %7s %9s" %
+          ("avstasks", "elapsed", "utt/sec", "p50 ms", "p90 ms", "p99 ms", "max ms", "failed", "messages"))
+    print("-" * 80)
+
+    throttles = []
+    try:
+        for level in levels:
+            OPTS.avstasks = level
+            results = ResultsQueue(OPTS.queueurl)
+
+            # Adaptive runs start at the level and find their own way
+            throttle = Throttle(level, OPTS.avsmax) if OPTS.adaptive else None
+            workers = throttle.ceiling if throttle is not None else level
+            if OPTS.engine == "async":
+                executor = ThreadPoolExecutor(max_workers=workers)
+            else:
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=worker_init)
+
+            latencies = []
+            failed = [0]
+            def collect(future):
+                if future.exception() is None:
+                    latency, stats = future.result()
+                    latencies.append(latency)
+                    if throttle is not None:
+                        throttle.add(stats)
+                else:
+                    failed[0] += 1
+                    if throttle is not None:
+                        throttle.fail()
+
+            start = time.time()
+            with executor:
+                pending = set()
+                for ndx in range(requests):
+                    limit = throttle.window() if throttle is not None else level * 2
+                    pending = submit_bounded(executor, pending, limit,
+                                             timed_avs, path, "loadtest_%d" % ndx,
+                                             callback=collect)
+                executor.shutdown(wait=True)
+            if throttle is not None:
+                throttles.append((level, throttle))
+
+            # Every response should have left a results message behind
+            messages = 0
+            while True:
+                msgs = results.receive(0)
+                if len(msgs) == 0:
+                    break
+                messages += len(msgs)
+            elapsed = time.time() - start
+
+            ms = np.percentile(latencies, [50, 90, 99, 100]) * 1000 if latencies else [0, 0, 0, 0]
+            print("%8d %10.2f %10.1f %9.0f %9.0f %9.0f %9.0f %7d %9d" %
+                  (level, elapsed, len(latencies) / elapsed, ms[0], ms[1], ms[2], ms[3], failed[0], messages))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    for level, throttle in throttles:
+        print()
+        print("Level %d:" % level)
+        throttle.report()
+
+    print()
+    print("Fake server: %(requests)d request(s), %(responses)d response(s), %(errors)d error(s), "
+          "%(forbidden)d 403(s), %(throttled)d 429(s), %(tokens)d token(s) issued" % server.stats)
 
 def main():
     global OPTS
@@ -730,28 +4514,76 @@ def main():
                         help="path to configuration file")
     parser.add_argument("-I", "--inputdir", type=str,
                         help="path to voice input directory")
+    parser.add_argument("-L", "--pipeline", action="store_const", const=True,
+                        help="send utterances to AVS as soon as they're generated")
     parser.add_argument("-O", "--outputdir", type=str,
                         help="path to voice output directory")
     parser.add_argument("-S", "--skilldir", type=str,
                         help="path to skill directory")
     parser.add_argument("-T", "--testsdir", type=str,
                         help="path to tests directory")
+    parser.add_argument("-B", "--benchmark", choices=["resample", "startup"],
+                        help="run a benchmark and exit")
+    parser.add_argument("-A", "--adaptive", action="store_const", const=True,
+                        help="adapt the number of concurrent AVS requests to AVS throttling")
     parser.add_argument("-a", "--avstasks", type=int,
                         help="number of concurrent AVS requests")
     parser.add_argument("-b", "--bypass", action="store_const", const=True,
                         help="bypass calling AVS to process utterance")
+    parser.add_argument("-K", "--compile", action="store_const", const=True,
+                        help="compile a plan for each test and exit")
+    parser.add_argument("-f", "--filter", type=str,
+                        help="only test utterances matching this regular expression")
+    parser.add_argument("-x", "--cover", type=int, metavar="T",
+                        help="only test enough utterances to cover every combination of T slot values")
+    parser.add_argument("-c", "--count", action="store_const", const=True,
+                        help="only report the number of permutations")
+    parser.add_argument("-e", "--engine", choices=["process", "async"],
+                        help="how concurrent AVS requests are run")
+    parser.add_argument("-H", "--handoff", choices=["file", "memory"],
+                        help="how voice input gets from TTS to AVS")
     parser.add_argument("-i", "--invocation", type=str,
                         help="invocation name of skill")
+    parser.add_argument("-G", "--fingerprint", action="store_const", const=True,
+                        help="store identical responses once and cluster similar ones for review")
     parser.add_argument("-k", "--keep", action="store_const", const=True,
                         help="keep the event/response for each utterance")
+    parser.add_argument("-Q", "--query", type=str, metavar="SQL",
+                        help="query the results store (runs, failures, slots, slowest or SQL) and exit")
     parser.add_argument("-q", "--queueurl", type=str,
                         help="SQS queue URL for results")
-    parser.add_argument("-r", "--regen", action="store_const", const=True,
-                        help="regenerate voice input files")
+    parser.add_argument("-n", "--incremental", action="store_const", const=True,
+                        help="only send utterances AVS hasn't already answered")
+    parser.add_argument("-E", "--refresh", action="store_const", const=True,
+                        help="send every utterance even if it's unchanged")
+    parser.add_argument("-R", "--resample", choices=["sinc_best", "sinc_medium", "sinc_fastest", "linear", "zero_order_hold"],
+                        help="quality of espeak resampling")
     parser.add_argument("-s", "--synth", choices=["espeak", "osx", "sapi"],
                         help="TTS synthesizer to use")
     parser.add_argument("-t", "--ttstasks", type=int,
                         help="number of concurrent TTS conversions")
+    parser.add_argument("-F", "--fakeserver", type=int, metavar="PORT",
+                        help="run the local AVS and SQS stand-in server")
+    parser.add_argument("-l", "--loadtest", type=str, metavar="LEVELS",
+                        help="load test a local stand-in server at these avstasks levels (e.g. 1,4,16)")
+    parser.add_argument("-m", "--trim", action="store_const", const=True,
+                        help="trim the silence around voice input before sending it")
+    parser.add_argument("-N", "--normalize", choices=["peak", "rms"],
+                        help="even out the level of voice input before sending it")
+    parser.add_argument("-p", "--splice", action="store_const", const=True,
+                        help="build utterances from separately synthesized phrases")
+    parser.add_argument("-M", "--metrics", type=str,
+                        help="path of the file stage timings and counts are written to")
+    parser.add_argument("-D", "--profile", choices=["login", "token", "tts", "resample", "condition",
+                                                    "splice", "write", "upload", "backoff", "sqs",
+                                                    "unittest", "fingerprint"],
+                        help="profile one stage of the run")
+    parser.add_argument("-P", "--synthserver", action="store_const", const=True,
+                        help="keep a synthesizer session open in each TTS task")
+    parser.add_argument("-u", "--unittasks", type=int,
+                        help="number of concurrent unit tests")
+    parser.add_argument("-U", "--unitmode", choices=["shell", "import"],
+                        help="how the unit test is run")
     parser.add_argument("-w", "--writeconfig",
                         help="path for generated configuration file")
 
@@ -766,6 +4598,14 @@ def main():
             print("Couldn't generate config file:", args.writeconfig)
         quit()
 
+    if args.benchmark == "resample":
+        bench_resample()
+        quit()
+
+    if args.benchmark == "startup":
+        bench_startup()
+        quit()
+
     # Create an instance of our base options
     OPTS = Options()
 
@@ -780,18 +4620,56 @@ def main():
         OPTS = Options()
         OPTS.merge_dict(json.load(args.config))
 
+        # Don't carry the open file around with the options
+        args.config.close()
+        args.config = None
+
     # Merge args into the options
     OPTS.merge_args(args)
 
+    if args.fakeserver is not None:
+        fake_server(args.fakeserver)
+        quit()
+
+    if args.loadtest is not None:
+        load_test([int(level) for level in args.loadtest.split(",")])
+        quit()
+
+    if args.query is not None:
+        if not OPTS.resultsdb:
+            parser.error("--query needs a resultsdb")
+        store = ResultsStore(OPTS.resultsdb)
+        try:
+            store.query(args.query)
+        except sqlite3.Error as e:
+            parser.error("query failed: %s" % e)
+        finally:
+            store.db.close()
+        quit()
+
     # Run the tests
-    tester = Tester()
     if OPTS.file:
-        for name in OPTS.file:
-            tester.process(name)
+        names = OPTS.file
     else:
-        for name in os.listdir(OPTS.testsdir):
-            if name.startswith("test_"):
-                tester.process(os.path.join(OPTS.testsdir, name))
+        names = [os.path.join(OPTS.testsdir, name) for name in os.listdir(OPTS.testsdir)
+                 if name.startswith("test_")]
+
+    tester = Tester()
+    tester.plan(names)
+    total = 0
+    try:
+        for name in names:
+            total += tester.process(name)
+    finally:
+        tester.close()
+
+    if OPTS.count:
+        print()
+        print("Permutations across all tests:", total)
+        if OPTS.cover:
+            print("Covering %d-wise across all tests: %d of %d permutations (%.1f%% fewer)" %
+                  (OPTS.cover, total, tester.matrix,
+                   100.0 * (tester.matrix - total) / tester.matrix if tester.matrix else 0.0))
 
 if __name__ == "__main__":
     main()